@@ -1,5 +1,8 @@
+import copy
+import time
 import numpy as np
 from utils import *
+from encoding import GroupIndex
 
 
 """
@@ -11,15 +14,153 @@ from utils import *
     group_base_rates: base rates, i.e. Pr[G] in terms of all loan applicants, all vaccine recipients, etc.
 """
 
-def run_test(incident_db, all_groups, base_rates, \
-                 ALPHA=0.05, BETA=1.5, max_iter=20000, method='eval', asymptotic=False): 
-    if method == 'eval':
+def get_test(all_groups, base_rates, ALPHA=0.05, method='eval', asymptotic=False, refine=None, sketch=None, profiler=None):
+    """
+    refine: if set (True, or a dict of `RefinementTest` options), the test starts from the coarsest groups and only
+    refines the suspicious ones (see `RefinementTest`).
+    sketch: if set (True, or a dict of `sketch.SketchLILTest` options), the LIL test keeps its group counts in a 
+    count-min sketch and exact counters only for groups near their thresholds.
+    profiler: if given, a `profiling.Profiler` attached to the test (per-phase timers, rejection callbacks).
+    ALPHA: a level, or a list / array of levels.
+    """
+    ALPHA = np.asarray(ALPHA, dtype=float) if np.ndim(ALPHA) > 0 else ALPHA
+    if sketch is not None and sketch is not False:
+        if method != 'lil':
+            raise ValueError('sketch-backed counting is only available for the LIL test')
+        from sketch import SketchLILTest
+        test = SketchLILTest(all_groups, base_rates, ALPHA, asymptotic=asymptotic, **(sketch if isinstance(sketch, dict) else {}))
+    elif refine is not None and refine is not False:
+        test = RefinementTest(all_groups, base_rates, ALPHA, method=method, asymptotic=asymptotic, **(refine if isinstance(refine, dict) else {}))
+    elif method == 'eval':
         test = GenericTest(all_groups, base_rates, ALPHA)
     elif method == 'sprt':
         test = SPRTest(all_groups, base_rates, ALPHA)
     elif method == 'lil':
         test = LILTest(all_groups, base_rates, ALPHA, asymptotic=asymptotic)
-    return test.run(incident_db, max_iter=max_iter, ALPHA=ALPHA, BETA=BETA)
+    else:
+        return None
+    return test if profiler is None else profiler.attach(test)
+
+def run_test(incident_db, all_groups, base_rates, \
+                 ALPHA=0.05, BETA=1.5, max_iter=20000, method='eval', asymptotic=False, encoded=True, vectorized=True, lmbd='ons', profiler=None): 
+    test = get_test(all_groups, base_rates, ALPHA, method=method, asymptotic=asymptotic, profiler=profiler)
+    return test.run(incident_db, max_iter=max_iter, lmbd=lmbd, ALPHA=test.alpha, BETA=BETA, encoded=encoded, vectorized=vectorized)
+
+def run_test_trials(incident_db, trial_inds, all_groups, base_rates, \
+                 ALPHA=0.05, BETA=1.5, max_iter=20000, method='eval', asymptotic=False, vectorized=True):
+    """
+    Same as `run_test`, but for every permutation `trial_inds[k]` of `incident_db` at once. 
+    Results have an extra `trial` column (k).
+    """
+    test = get_test(all_groups, base_rates, ALPHA, method=method, asymptotic=asymptotic)
+    return test.run_trials(incident_db, trial_inds, max_iter=max_iter, BETA=BETA, vectorized=vectorized)
+
+def run_algorithms(incident_db, trial_inds, all_groups, base_rates, algorithms, \
+                 ALPHA=0.05, BETA=1.5, max_iter=20000, vectorized=True, return_usage=False):
+    """
+    Runs every algorithm in `algorithms` (configs `{'name': ..., 'params': {'method': ..., 'asymptotic': ..., 'lmbd': ...}}`
+    as in `run_experiment.py`) on the permutations `trial_inds` of `incident_db`, in one fused pass (see `run_fused`).
+    Returns the results of `run_test_trials` for every algorithm, stacked with an `alg` column.
+    return_usage: also return the resources used, as a df with columns trial, alg, wall_s, cpu_s, reports:
+        each test's usage (see `run_fused`) split over the trials in proportion to the reports each processed.
+    """
+    tests = [get_test(all_groups, base_rates, ALPHA, method=alg['params'].get('method', 'eval'), asymptotic=alg['params'].get('asymptotic', False),
+                      refine=alg['params'].get('refine'), sketch=alg['params'].get('sketch')) for alg in algorithms]
+    lmbds = [alg['params'].get('lmbd', 'ons') for alg in algorithms]
+    all_results = [None] * len(tests)
+    fused = [i for i, test in enumerate(tests) if test.fused]
+    if fused:
+        for i, results in zip(fused, run_fused(incident_db, trial_inds, [tests[i] for i in fused], max_iter=max_iter, BETA=BETA,
+                                               lmbds=[lmbds[i] for i in fused], vectorized=vectorized)):
+            all_results[i] = results
+    for i, test in enumerate(tests):
+        if not test.fused:
+            start = _clock()
+            all_results[i] = test.run_trials(incident_db, trial_inds, max_iter=max_iter, lmbd=lmbds[i], BETA=BETA, vectorized=vectorized)
+            test.usage = _clock() - start
+            test.reports = np.array([max(0, min(max_iter, len(inds)) - 1) for inds in trial_inds])
+    for alg, results in zip(algorithms, all_results):
+        results['alg'] = alg['name']
+    results = pd.concat(all_results, ignore_index=True)
+    if not return_usage:
+        return results
+    usage = []
+    for alg, test in zip(algorithms, tests):
+        share = test.reports / test.reports.sum() if test.reports.sum() else np.full(len(test.reports), 1 / len(test.reports))
+        usage.append(pd.DataFrame({'trial': np.arange(len(share)), 'alg': alg['name'], 'wall_s': test.usage[0] * share,
+                                   'cpu_s': test.usage[1] * share, 'reports': test.reports}))
+    return results, pd.concat(usage, ignore_index=True)
+
+def run_fused(incident_db, trial_inds, tests, max_iter=20000, BETA=1.5, lmbds=None, vectorized=True, chunk_size=2**21):
+    """
+    Runs several tests (on the same groups) over the permutations `trial_inds` of `incident_db` in one pass.
+    Reports are encoded once, and for each block of steps the membership flags and cumulative group counts are 
+    computed once and fed to every test, each of which keeps its own state and stopping bookkeeping.
+    trial_inds: (K, N) array, or K index arrays of different lengths (e.g. each trial on its own subset of the reports);
+        shorter trials are padded and nothing is recorded for them past their own last step.
+    lmbds: betting strategy for each test (see `GenericTest.run`), default 'ons'.
+    Returns the results of `test.run_trials` for each test.
+    Each test's resource usage is left in `test.usage` (wall, CPU seconds): its own work plus an equal share of the 
+    work shared by the tests still running; `test.reports` is the number of reports it processed in each trial.
+    """
+    mark = _clock()
+    index = GroupIndex(tests[0].all_groups)
+    lengths = np.array([len(inds) for inds in trial_inds])
+    if np.all(lengths == lengths[0]):
+        cells = index.encode(incident_db)[np.asarray(trial_inds)]
+    else:
+        padded = np.zeros((len(trial_inds), lengths.max()), dtype=int)
+        for k, inds in enumerate(trial_inds):
+            padded[k, :lengths[k]] = inds
+        cells = index.encode(incident_db)[padded]
+    K, N = cells.shape
+    # trial k runs steps 1 .. stop[k]-1
+    stop = np.minimum(max_iter, lengths)
+    ragged = np.any(stop != stop.max())
+    lmbds = ['ons']*len(tests) if lmbds is None else lmbds
+    for test, lmbd in zip(tests, lmbds):
+        test.index = index
+        test._start_batch(K, np.atleast_1d(BETA), lmbd, vectorized)
+        test.usage, test.reports = (_clock() - mark) / len(tests), np.zeros(K, dtype=int)
+
+    # steps per block, so that the (K, B, A, block, G) arrays of closed-form tests stay small
+    width = max(test.reject_t[0].size if test._vectorized else index.G for test in tests)
+    chunk = max(1, chunk_size // (K * width))
+    counts = np.zeros((K, index.G))
+    active = list(tests)
+    for start in range(1, stop.max(), chunk):
+        mark = _clock()
+        ts = np.arange(start, min(start + chunk, stop.max()))
+        live = ts < stop[:, None] if ragged else None
+        # sparse index: tests update from the member lists of the cells, and the dense flags are only built for the
+        # cumulative counts of closed-form tests
+        block = cells[:, ts-1] if index.sparse else None
+        flags = cum = None
+        if not index.sparse or any(test._vectorized for test in active):
+            flags = index.flags(cells[:, ts-1])
+            cum = counts[:, None, :] + np.cumsum(flags, axis=1)
+            counts = cum[:, -1, :]
+        now = _clock()
+        shared, steps = (now - mark) / len(active), np.clip(stop - start, 0, len(ts))
+        for test in active:
+            test._consume(flags, cum, ts, live, cells=block)
+            mark, now = now, _clock()
+            test.usage += shared + now - mark
+            test.reports += steps
+        active = [test for test in active if not test._finished()]
+        if not active:
+            break
+    results = []
+    for test in tests:
+        mark = _clock()
+        results.append(test._batch_results(BETA))
+        test._end_batch()
+        test.usage += _clock() - mark
+    return results
+
+def _clock():
+    # (wall, CPU) time, in seconds
+    return np.array([time.perf_counter(), time.process_time()])
 
 ##############################################
 ####### algs written for a single beta #######
@@ -29,25 +170,50 @@ class GenericTest:
     """
     The base class `GenericTest` implements Bonferroni.
     Other methods are subclasses of `GenericTest` and may implement their own update and selection steps.
+    Subclasses whose statistic only depends on t and the cumulative group counts set `closed_form = True`
+    and implement `_closed_form_stats`, which lets `run` evaluate the whole stream at once from prefix sums.
+
+    `ALPHA` may be a vector of levels: the test statistic is advanced once and rejections are recorded 
+    for every level, with an `alpha` column added to the results.
+    Likewise `BETA` (in `run`/`run_trials`) may be a vector: every null `mu_0 = beta * base_rates` is tested 
+    against the same pass over the reports, keeping (beta x group) state, with a `beta` column added to the results.
     """
+    closed_form = False
+    fused = True # can be run by `run_fused`
+
     def __init__(self, all_groups, base_rates, ALPHA = 0.05, return_single=False):
 
         self.G = len(all_groups)
         self.base_rates = base_rates
         self.all_groups = all_groups
-        self.alpha = ALPHA
-        self.thresh = np.log(self.G/ALPHA)
+        self.feature_names = list(dict.fromkeys(k for group in all_groups for k in group)) # features some group constrains
+        # a list of levels works like an array; a single level stays a scalar
+        self.alphas = np.atleast_1d(np.asarray(ALPHA, dtype=float))
+        self.multi_alpha = np.ndim(ALPHA) > 0
+        self._set_alpha(self.alphas if self.multi_alpha else self.alphas[0])
         self.return_single = return_single
+
+    def _set_alpha(self, alpha):
+        self.alpha = alpha if np.ndim(alpha) == 0 else np.asarray(alpha, dtype=float)
+        self.thresh = np.log(self.G/self.alpha)
     
-    def run(self, incident_db, max_iter=20000, lmbd='ons', BETA=1, ALPHA=None):
+    def run(self, incident_db, max_iter=20000, lmbd='ons', BETA=1, ALPHA=None, encoded=True, vectorized=True):
         """
         Main algorithm for running test with reports `incident_db`. 
+        If `encoded`, reports are compiled once into cell ids (see `encoding.py`) and group membership is a table lookup;
+        otherwise every report is compared to every group dict.
+        If `vectorized` and the test has a closed form, the whole stream is evaluated with array ops (same results).
         """
+        if self.multi_alpha or np.ndim(BETA) > 0 or (encoded and vectorized and self.closed_form and not self.return_single):
+            results = self.run_trials(incident_db, np.arange(len(incident_db))[None, :], max_iter=max_iter, lmbd=lmbd, BETA=BETA, vectorized=vectorized)
+            return results.drop(columns='trial')
+        if encoded:
+            self.index = GroupIndex(self.all_groups)
+            self.cells = self.index.encode(incident_db)
+        else:
+            self.index = None
 
-        self.omega_g = np.zeros(self.G)
-        self.lambda_g = np.zeros(self.G) # np.ones(self.G)*0.5
-        self.lambda_counter = np.zeros(self.G)  # sum of second moments for ONS, group counts for agrapa
-        self.lambdavar_counter = np.zeros(self.G) # for agrapa, sum (X_i - muhat_i)^2
+        self._reset_state(self.G)
 
         rejected_groups = []
         rejected_times = []
@@ -57,44 +223,187 @@ class GenericTest:
         self.t = 1
         while self.t < min(max_iter, len(incident_db)):
             self._one_step_update(incident_db, BETA, lmbd) # this updates self.t
-            # check if any group passes
-            if np.any(self.omega_g > self.thresh - np.log(self.G)):
-                    rejected_inds = np.where(self.omega_g > np.log(1/self.alpha))[0]
-                    for ind in rejected_inds:
-                        # only add if not already in rejected_nulls
-                        if ind not in rejected_invalid.keys():
-                            rejected_invalid[ind] = self.t
-            if np.any(self.omega_g > self.thresh):
-                if self.return_single:
-                    return self.t, np.argmax(self.omega_g)
-                else:
-                    rejected_inds = np.where(self.omega_g > self.thresh)[0]
-                    for ind in rejected_inds:
-                        # only add if not already in rejected_nulls
-                        if ind not in rejected_groups:
-                            rejected_groups.append(ind)
-                            rejected_times.append(self.t)
+            if self._check_rejections(rejected_groups, rejected_times, rejected_invalid) and self.return_single:
+                return self.t, np.argmax(self.omega_g)
 
         invalid_t = [rejected_invalid[g] for g in rejected_groups]
 
         results = pd.DataFrame({'group': rejected_groups, 't': rejected_times, 't-inv': invalid_t})
         return results
+
+    def _check_rejections(self, rejected_groups, rejected_times, rejected_invalid):
+        """
+        Rejection bookkeeping of `run` after a step: records the invalid times and the newly rejected groups.
+        Returns {group: invalid time} of the newly rejected groups.
+        """
+        # check if any group passes
+        if np.any(self.omega_g > self.thresh - np.log(self.G)):
+                rejected_inds = np.where(self.omega_g > np.log(1/self.alpha))[0]
+                for ind in rejected_inds:
+                    # only add if not already in rejected_nulls
+                    if ind not in rejected_invalid.keys():
+                        rejected_invalid[ind] = self.t
+        new = {}
+        if np.any(self.omega_g > self.thresh):
+            rejected_inds = np.where(self.omega_g > self.thresh)[0]
+            for ind in rejected_inds:
+                # only add if not already in rejected_nulls
+                if ind not in rejected_groups:
+                    rejected_groups.append(ind)
+                    rejected_times.append(self.t)
+                    new[ind] = rejected_invalid[ind]
+        return new
+
+    def run_trials(self, incident_db, trial_inds, max_iter=20000, lmbd='ons', BETA=1, vectorized=True):
+        """
+        Runs the test on every permutation `trial_inds[k]` of the reports `incident_db` in one pass.
+        All state is kept as (trials x groups) arrays and every trial advances together at step t, 
+        so the per-step Python overhead is paid once for the whole batch.
+        Returns the results of `run` for each trial, stacked with a `trial` column (k) 
+        (and `beta` / `alpha` columns if several values are given).
+        """
+        return run_fused(incident_db, trial_inds, [self], max_iter=max_iter, BETA=BETA, lmbds=[lmbd], vectorized=vectorized)[0]
+
+    def _start_batch(self, K, betas, lmbd, vectorized):
+        """
+        Sets up state for K streams, all nulls `betas` and all levels `self.alphas`, to be advanced by `_consume`. 
+        Rejection and invalid times are kept in (K, B, A, G) arrays (0 = never).
+        """
+        self._vectorized = vectorized and self.closed_form
+        self._lmbd = lmbd
+        shape = (K, len(betas), len(self.alphas), self.G)
+        self.reject_t = np.zeros(shape, dtype=int)
+        self.invalid_t = np.zeros(shape, dtype=int)
+        if self._vectorized:
+            self._BETA = betas[:, None, None, None]
+        else:
+            # state is (K, B, 1, G), so that thresholds broadcast to (K, B, A, G)
+            self._BETA = betas[:, None, None]
+            self._alpha = self.alpha
+            self._set_alpha(self.alphas[:, None])
+            self._reset_state((K, len(betas), 1, self.G))
+            self.t = 1
+
+    def _consume(self, flags, counts, ts, live=None, cells=None):
+        """
+        Advances all streams through steps `ts`, given the membership flags of reports `ts - 1` (K, len(ts), G) 
+        and the cumulative group counts after each of them (K, len(ts), G).
+        live: (K, len(ts)) mask of the steps each stream actually has (default all); nothing is recorded at the others.
+        cells: cells of reports `ts - 1` (K, len(ts)), given with a sparse index: tests without a closed form then
+            update from the groups containing each report (see `_update_members`), and `flags` may be None.
+        Closed-form tests evaluate the statistic and threshold curve at all steps at once from `counts`;
+        other tests update their state one step at a time.
+        """
+        if self._vectorized:
+            alpha = self.alphas[:, None, None]
+            omega, thresh = self._closed_form_stats(counts[:, None, None], ts, self._BETA, alpha)
+            gate = np.any(omega > thresh - np.log(self.G), axis=-1, keepdims=True)
+            alive = True if live is None else live[:, None, None, :, None]
+            _record_first(self.invalid_t, alive & gate & (omega > np.log(1/alpha)), ts)
+            _record_first(self.reject_t, alive & (omega > thresh), ts)
+        else:
+            for i in range(len(ts)):
+                if cells is not None:
+                    self._update_members(cells[:, i], self._BETA, self._lmbd) # this updates self.t
+                else:
+                    self._update_state(flags[:, i, None, None, :], self._BETA, self._lmbd) # this updates self.t
+                alive = True if live is None else live[:, i, None, None, None]
+                gate = np.any(self.omega_g > self.thresh - np.log(self.G), axis=-1, keepdims=True)
+                self.invalid_t[alive & gate & (self.omega_g > np.log(1/self.alpha)) & (self.invalid_t == 0)] = self.t
+                self.reject_t[alive & (self.omega_g > self.thresh) & (self.reject_t == 0)] = self.t
+
+    def _finished(self):
+        # nothing left to record once every group has been rejected and flagged as invalid
+        return np.all(self.reject_t > 0) and np.all(self.invalid_t > 0)
+
+    def _end_batch(self):
+        if not self._vectorized:
+            self._set_alpha(self._alpha)
+
+    def _batch_results(self, BETA, since=0):
+        """
+        Results of the batch run, with `beta` / `alpha` columns only if several values were given.
+        since: only keep rejections recorded after step `since`.
+        """
+        axes = {'trial': np.arange(len(self.reject_t))}
+        keep = [slice(None)]
+        for name, values, multi in [('beta', np.atleast_1d(BETA), np.ndim(BETA) > 0), ('alpha', self.alphas, self.multi_alpha)]:
+            if multi:
+                axes[name] = values
+            keep.append(slice(None) if multi else 0)
+        reject_t = self.reject_t[tuple(keep)]
+        return _results_frame(np.where(reject_t > since, reject_t, 0), self.invalid_t[tuple(keep)], axes)
+
+    def _reset_state(self, shape):
+        self.omega_g = np.zeros(shape)
+        self.lambda_g = np.zeros(shape) # np.ones(self.G)*0.5
+        self.lambda_counter = np.zeros(shape)  # sum of second moments for ONS, group counts for agrapa
+        self.lambdavar_counter = np.zeros(shape) # for agrapa, sum (X_i - muhat_i)^2
     
+    def _closed_form_stats(self, counts, ts, BETA, alpha):
+        """
+        Test statistic and threshold at steps `ts`, both broadcastable to (K, B, A, len(ts), G), 
+        given cumulative group counts `counts` (K, 1, 1, len(ts), G), nulls `BETA` (B, 1, 1, 1) and levels `alpha` (A, 1, 1).
+        """
+        raise NotImplementedError
+
     def _one_step_update(self, incident_db, BETA, lmbd):
+        """
+        Feeds the current report to `_update_state`.
+        """
+        self._update_state(self._get_row_flags(incident_db), BETA, lmbd)
+
+    def _update_state(self, row_flags, BETA, lmbd):
         """
         Updates omegas & lambdas. 
         Updates t.
+        `row_flags` is the membership vector of the current report, or a (K, G) array for K streams at once.
         """
         mu_0 = BETA * self.base_rates
-        # current report 
-        curr_report = incident_db.iloc[self.t-1]
-        row_flags = np.array([np.product([curr_report[k] == group[k] for k in group]) for group in self.all_groups])
         g_t = row_flags - mu_0
         # positive capital process
         dot = self._update_omega(g_t)
         self._update_lambda(g_t, dot, lmbd, BETA)
         self.t += 1
-   
+
+    def _update_members(self, cells, BETA, lmbd):
+        """
+        `_update_state` of the (K, B, 1, G) batch state given the cells of the K streams' reports (K,), without 
+        building their (K, G) membership flags: every group is updated as a non-member in one vectorized pass, then 
+        the groups containing each report are updated again, as members, from their state before the step.
+        """
+        k, g = self.index.member_pairs(cells)
+        members = copy.copy(self)
+        # without instance-level wrappers (e.g. a profiler's), which are bound to `self`
+        members.__dict__ = {name: value for name, value in vars(self).items() if not callable(value)}
+        for name in ['omega_g', 'lambda_g', 'lambda_counter', 'lambdavar_counter']:
+            # (len(g), B, 1) -> (1, B, 1, len(g)), the state of a single stream over the member groups
+            setattr(members, name, np.moveaxis(getattr(self, name)[k, :, :, g], 0, -1)[None])
+        members.base_rates, members.G = self.base_rates[g], len(g)
+        self._update_state(0., BETA, lmbd)
+        members._update_state(1., BETA, lmbd)
+        for name in ['omega_g', 'lambda_g', 'lambda_counter', 'lambdavar_counter']:
+            getattr(self, name)[k, :, :, g] = np.moveaxis(getattr(members, name)[0], -1, 0)
+
+    def _replay(self, flags, BETA, lmbd):
+        """
+        Feeds the membership flags of several reports (n, G) to `_update_state`, in order.
+        """
+        for row_flags in flags:
+            self._update_state(row_flags, BETA, lmbd)
+
+    def _get_row_flags(self, incident_db):
+        """
+        Group membership of the current report.
+        """
+        if self.index is not None:
+            return self.index.row_flags(self.cells[self.t-1])
+        curr_report = self._get_row(incident_db)
+        return np.array([np.product([curr_report[k] == group[k] for k in group]) for group in self.all_groups])
+
+    def _get_row(self, incident_db):
+        return incident_db.iloc[self.t-1]
+
     def _update_omega(self, g_t):
         dot = g_t*self.lambda_g
         self.omega_g += np.log(1 + dot)
@@ -119,40 +428,274 @@ class GenericTest:
             self.lambda_g = np.clip(self.lambda_g, 0, 1/(self.base_rates*BETA))
 
 class SPRTest(GenericTest):
+    closed_form = True
+
     def __init__(self, all_groups, base_rates, ALPHA = 0.05, return_single=False):
         super().__init__(all_groups, base_rates, ALPHA, return_single)
         # note that self.lambda_counter will be group counts
 
-    def _one_step_update(self, incident_db, BETA, lmbd=None):
+    def _update_state(self, row_flags, BETA, lmbd=None):
         """
         Updates counts (per group test statistics)
         Updates t.
         """
         mu = BETA * self.base_rates
         eps = 0.05
-        # current report 
-        curr_report = incident_db.iloc[self.t-1]
-        row_flags = np.array([np.product([curr_report[k] == group[k] for k in group]) for group in self.all_groups])
         # test statistic for SPRT is as follows 
         self.lambda_counter += row_flags
         self.omega_g = self.lambda_counter*np.log(1 + eps) + (self.t - self.lambda_counter)*(np.log(np.maximum(0.01, (1 - (1+eps)*mu))) - np.log(1 - mu))
         self.t += 1
 
+    def _replay(self, flags, BETA, lmbd=None):
+        # the statistic only depends on the counts: add up all but the last report, then take one step
+        if len(flags):
+            self.lambda_counter += flags[:-1].sum(axis=0)
+            self.t += len(flags) - 1
+            self._update_state(flags[-1], BETA)
+
+    def _closed_form_stats(self, counts, ts, BETA, alpha):
+        mu = BETA * self.base_rates
+        eps = 0.05
+        t = ts[:, None]
+        omega = counts*np.log(1 + eps) + (t - counts)*(np.log(np.maximum(0.01, (1 - (1+eps)*mu))) - np.log(1 - mu))
+        return omega, np.log(self.G/alpha)
+
 class LILTest(GenericTest):
+    closed_form = True
 
     def __init__(self, all_groups, base_rates, ALPHA = 0.05, return_single=False, asymptotic=False):
         super().__init__(all_groups, base_rates, ALPHA, return_single)
         self.asymp = asymptotic
 
-    def _one_step_update(self, incident_db, BETA, lmbd=None):
+    def _update_state(self, row_flags, BETA, lmbd=None):
 
         mu = BETA * self.base_rates
-        # current report 
-        curr_report = incident_db.iloc[self.t-1]
-        row_flags = np.array([np.product([curr_report[k] == group[k] for k in group]) for group in self.all_groups])
         # test statistic is count vs. a group-specific threshold
         self.omega_g += row_flags
         thresh_factor = np.sqrt(np.minimum(mu, 1)*np.maximum((1-mu), 0)) if self.asymp else 0.5
         thresh = (self.t)*mu + thresh_factor*np.sqrt(2.07*(self.t)*np.log((2+np.log2(self.t))**2/self.alpha))
         self.thresh = 20000 if (self.t < 25 and self.asymp) else thresh
-        self.t += 1
\ No newline at end of file
+        self.t += 1
+
+    def _replay(self, flags, BETA, lmbd=None):
+        # the statistic only depends on the counts: add up all but the last report, then take one step
+        if len(flags):
+            self.omega_g += flags[:-1].sum(axis=0)
+            self.t += len(flags) - 1
+            self._update_state(flags[-1], BETA)
+
+    def _closed_form_stats(self, counts, ts, BETA, alpha):
+        mu = BETA * self.base_rates
+        t = ts[:, None]
+        thresh_factor = np.sqrt(np.minimum(mu, 1)*np.maximum((1-mu), 0)) if self.asymp else 0.5
+        thresh = t*mu + thresh_factor*np.sqrt(2.07*t*np.log((2+np.log2(t))**2/alpha))
+        if self.asymp:
+            thresh = np.where(t < 25, 20000, thresh)
+        return counts, thresh
+
+class RefinementTest(GenericTest):
+    """
+    Hierarchical adaptive refinement over the lattice of groups `all_groups`: only the coarsest groups (those with no
+    parent in the lattice, e.g. single-feature marginals) are tested from the start. Once a group looks suspicious
+    (see `_promoted`), its children (the groups with one more feature that contain it) are spawned and tested too, 
+    so the per-report cost follows the number of active groups rather than the size of the lattice.
+
+    The tests themselves are those of `method` / `asymptotic` (as in `get_test`), and thresholds keep the Bonferroni 
+    correction over the full lattice (G = len(all_groups)). With `replay`, a spawned group's statistic is computed 
+    over the whole stream so far (from the stored report cells), i.e. it is the full-lattice test's statistic, and 
+    every rejection is one the full-lattice test also makes, so the family-wise error is controlled as for that test. 
+    (A group that already crossed its threshold before being spawned is recorded when it is spawned.) Without 
+    `replay`, a spawned group's e-process starts at 1 when it is spawned, which is also valid, and cheaper for tests 
+    without a closed form (replaying them costs one step per past report), but less powerful; closed-form tests 
+    (whose statistics are functions of the counts) are always replayed, in one step.
+
+    Promotion: a group spawns its children once its statistic passes `promote_frac` x its rejection threshold
+    (for LIL, whose statistic is a count: once its excess over the null count does so for the threshold's),
+    or once it has at least `min_count` reports and its observed report rate is above `promote_ratio` x its base rate
+    (a group can be over-reported within a parent that is not over-reported enough to be rejected); report counts
+    of spawned groups include the reports before they were spawned, replayed or not.
+    Invalid (uncorrected) times are only gated on the active groups.
+    Results are as for `run` / `run_trials`; `spawned_t` maps each spawned group to the step it was spawned at and
+    `group_steps` counts (active groups x steps) of the last run.
+    """
+    fused = False
+
+    def __init__(self, all_groups, base_rates, ALPHA = 0.05, method='eval', asymptotic=False, 
+                 promote_frac=0.5, promote_ratio=1.5, min_count=10, replay=False):
+        super().__init__(all_groups, base_rates, ALPHA)
+        self.base_rates = np.asarray(base_rates, dtype=float)
+        self.method, self.asymptotic = method, asymptotic
+        self.promote_frac, self.promote_ratio, self.min_count = promote_frac, promote_ratio, min_count
+        self.replay = replay
+
+        # children[g]: groups with exactly one more (feature, value) than g
+        items = [frozenset(group.items()) for group in all_groups]
+        ids = {s: g for g, s in enumerate(items)}
+        self.children = [[] for _ in all_groups]
+        has_parent = np.zeros(self.G, dtype=bool)
+        for c, s in enumerate(items):
+            for item in s:
+                p = ids.get(s - {item})
+                if p is not None:
+                    self.children[p].append(c)
+                    has_parent[c] = True
+        self.roots = np.flatnonzero(~has_parent)
+
+    def run(self, incident_db, max_iter=20000, lmbd='ons', BETA=1, ALPHA=None, encoded=True, vectorized=True):
+        """
+        Same as `GenericTest.run`; reports are always encoded.
+        """
+        if self.multi_alpha or np.ndim(BETA) > 0:
+            return self.run_trials(incident_db, np.arange(len(incident_db))[None, :], max_iter=max_iter, lmbd=lmbd, BETA=BETA).drop(columns='trial')
+        self.index = GroupIndex(self.all_groups)
+        reject_t, invalid_t = self._run_cells(self.index.encode(incident_db), max_iter, lmbd, BETA, self.alpha if ALPHA is None else ALPHA)
+        return _results_frame(reject_t, invalid_t)
+
+    def run_trials(self, incident_db, trial_inds, max_iter=20000, lmbd='ons', BETA=1, vectorized=True):
+        """
+        Same as `GenericTest.run_trials`, running each trial, beta and level in turn.
+        """
+        self.index = GroupIndex(self.all_groups)
+        cells = self.index.encode(incident_db)
+        betas = np.atleast_1d(BETA)
+        shape = (len(trial_inds), len(betas), len(self.alphas), self.G)
+        self.reject_t, self.invalid_t = np.zeros(shape, dtype=int), np.zeros(shape, dtype=int)
+        for k, inds in enumerate(trial_inds):
+            for b, beta in enumerate(betas):
+                for a, alpha in enumerate(self.alphas):
+                    self.reject_t[k, b, a], self.invalid_t[k, b, a] = self._run_cells(cells[np.asarray(inds)], max_iter, lmbd, beta, alpha)
+        return self._batch_results(BETA)
+
+    def _run_cells(self, cells, max_iter, lmbd, BETA, alpha):
+        # one stream of encoded reports; returns (rejection times, invalid times) over all groups (0 = never)
+        reject_t, invalid_t = np.zeros(self.G, dtype=int), np.zeros(self.G, dtype=int)
+        self.spawned_t = {}
+        self.group_steps = 0
+        self.active = np.zeros(0, dtype=int)
+        self.promoted = np.zeros(self.G, dtype=bool)
+        self._inner, self._counts = None, np.zeros(0)
+        self._spawn(self.roots, cells, 1, BETA, lmbd, alpha, reject_t, invalid_t)
+
+        log_thresh = np.log(self.G/alpha)
+        t = 1
+        while t < min(max_iter, len(cells)):
+            flags = self._flags(cells[t-1])
+            self._counts += flags
+            self._inner._update_state(flags, BETA, lmbd)
+            t += 1
+            self.group_steps += len(self.active)
+            self._record(t, log_thresh, alpha, reject_t, invalid_t)
+
+            promoted = self._promoted(t, BETA)
+            if np.any(promoted):
+                self.promoted[self.active[promoted]] = True
+                new = np.unique([c for g in self.active[promoted] for c in self.children[g]]).astype(int)
+                new = new[~np.isin(new, self.active)]
+                if len(new):
+                    self._spawn(new, cells, t, BETA, lmbd, alpha, reject_t, invalid_t)
+        return reject_t, invalid_t
+
+    def _flags(self, cells, groups=None):
+        # membership of reports `cells` in `groups` (default the active ones), without building full (.., G) rows
+        if not self.index.sparse:
+            return self._table[cells] if groups is None else self.index.table[np.ix_(cells, groups)]
+        if groups is None:
+            column = self._column
+        else:
+            column = np.full(self.G, -1)
+            column[groups] = np.arange(len(groups))
+        uniq, inverse = np.unique(cells, return_inverse=True)
+        rows = np.zeros((len(uniq), len(self.active) if groups is None else len(groups)))
+        for i, cell in enumerate(uniq):
+            members = column[self.index.members(cell)]
+            rows[i, members[members >= 0]] = 1
+        return rows[inverse].reshape(np.shape(cells) + rows.shape[1:])
+
+    def _record(self, t, log_thresh, alpha, reject_t, invalid_t):
+        omega, thresh = self._inner.omega_g, self._inner.thresh
+        active = self.active
+        if np.any(omega > thresh - np.log(self.G)):
+            hits = active[omega > np.log(1/alpha)]
+            invalid_t[hits[invalid_t[hits] == 0]] = t
+        hits = active[omega > thresh]
+        reject_t[hits[reject_t[hits] == 0]] = t
+
+    def _promoted(self, t, BETA):
+        # active groups that pass the promotion criterion and have not spawned their children yet
+        mu = BETA * self.base_rates[self.active]
+        omega, thresh = self._inner.omega_g, self._inner.thresh
+        if isinstance(self._inner, LILTest):
+            # the statistic is a count: compare its excess over the null count to the threshold's
+            omega, thresh = omega - mu * (t - 1), thresh - mu * (t - 1)
+        suspicious = (omega > self.promote_frac * thresh) | \
+                     ((self._counts >= self.min_count) & (self._counts > self.promote_ratio * self.base_rates[self.active] * (t - 1)))
+        return suspicious & ~self.promoted[self.active]
+
+    def _spawn(self, new, cells, t, BETA, lmbd, alpha, reject_t, invalid_t):
+        # starts testing groups `new` at step t, replaying reports 0 .. t-2 into their state if `replay`
+        child = self._new_test(new, alpha)
+        history = cells[:t-1] if self.replay or child.closed_form else cells[:0]
+        flags = self._flags(history, new)
+        child._replay(flags, BETA, lmbd)
+        child.t = t
+        if len(history):
+            counts = flags.sum(axis=0)
+        else:
+            # report counts (for the observed-rate promotion) are always over the whole stream so far
+            uniq, n = np.unique(cells[:t-1], return_counts=True)
+            counts = n @ self._flags(uniq, new)
+        for g in new:
+            self.spawned_t[int(g)] = t
+
+        if self._inner is None:
+            merged = child
+        else:
+            merged = self._new_test(np.concatenate([self.active, new]), alpha)
+            for name in ['omega_g', 'lambda_g', 'lambda_counter', 'lambdavar_counter']:
+                setattr(merged, name, np.concatenate([getattr(self._inner, name), getattr(child, name)]))
+            merged.t = t
+            if np.ndim(self._inner.thresh) > 0 or np.ndim(child.thresh) > 0:
+                merged.thresh = np.concatenate([np.broadcast_to(self._inner.thresh, len(self.active)), np.broadcast_to(child.thresh, len(new))])
+            else:
+                merged.thresh = self._inner.thresh
+        self.active = np.concatenate([self.active, new])
+        self._counts = np.concatenate([self._counts, counts])
+        self._inner = merged
+        if self.index.sparse:
+            self._column = np.full(self.G, -1) # position of each group among the active ones
+            self._column[self.active] = np.arange(len(self.active))
+        else:
+            self._table = self.index.table[:, self.active]
+        if len(history):
+            # spawned groups may already be past their thresholds
+            self._record(t, np.log(self.G/alpha), alpha, reject_t, invalid_t)
+
+    def _new_test(self, groups, alpha):
+        # test of `method` on `groups`, with the Bonferroni threshold of the full lattice
+        test = get_test([self.all_groups[g] for g in groups], self.base_rates[groups], alpha, method=self.method, asymptotic=self.asymptotic)
+        test._reset_state(len(groups))
+        test.thresh = np.log(self.G/alpha)
+        test.t = 1
+        return test
+
+def _record_first(times, hits, ts):
+    """
+    For entries of `times` (..., G) not yet set, record the first step in `ts` where `hits` (..., len(ts), G) is true.
+    Times are stored as in `run`, i.e. one past the step index.
+    """
+    new = np.any(hits, axis=-2) & (times == 0)
+    times[new] = ts[np.argmax(hits, axis=-2)][new] + 1
+
+def _results_frame(reject_t, invalid_t, axes={}):
+    """
+    Rejection records in the format returned by `run`, ordered by rejection time then group.
+    reject_t, invalid_t: arrays of times (0 = never rejected) whose last axis is the group. 
+    axes: {column name: values} for each leading axis, e.g. {'trial': np.arange(K)}; 
+        records are ordered by these columns first.
+    """
+    idx = np.nonzero(reject_t)
+    order = np.lexsort((idx[-1], reject_t[idx]) + idx[:-1][::-1])
+    idx = tuple(i[order] for i in idx)
+    results = {name: np.asarray(values)[i] for (name, values), i in zip(axes.items(), idx[:-1])}
+    results.update({'group': idx[-1], 't': reject_t[idx], 't-inv': invalid_t[idx]})
+    return pd.DataFrame(results)
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from algorithms import run_test
+from load_data import DATASETS, get_data
+from synthetic import lattice
+
+"""
+    Benchmarks of the tests on standard workloads: the bundled datasets and synthetic ones at growing numbers of
+    groups G and reports N.
+
+    Every case times `run_test` of one method (eval with both betting strategies, sprt, lil, asymptotic lil) on one
+    workload, `--REPEATS` times, and records reports/sec and mean per-step latency (from the fastest run), plus the
+    peak memory allocated during one extra run under `tracemalloc` (numpy buffers included). Results are written as
+    JSON with the revision and environment they were measured on, so that two revisions can be compared:
+        python benchmark.py --OUT=before.json
+        (switch revision)
+        python benchmark.py --OUT=after.json
+        python benchmark.py --COMPARE=before.json,after.json
+"""
+
+CASES = {
+    'eval-ons': {'method': 'eval', 'lmbd': 'ons'},
+    'eval-agrapa': {'method': 'eval', 'lmbd': 'agrapa'},
+    'sprt': {'method': 'sprt'},
+    'lilt': {'method': 'lil', 'asymptotic': False},
+    'lila': {'method': 'lil', 'asymptotic': True},
+}
+
+# synthetic workloads (`synthetic.lattice`, first finest group planted at beta 2):
+# (# features, # values per feature, # reports); G = (values + 1)^features - 1
+SYNTHETIC = {
+    'synth-G63-N5k': (3, 3, 5000),
+    'synth-G624-N20k': (4, 4, 20000),
+    'synth-G624-N100k': (4, 4, 100000),
+    'synth-G7775-N20k': (5, 5, 20000),
+}
+
+def get_workload(name, max_iter=40000):
+    """
+    (reports, group_dicts, base_rates, max_iter) of a workload: a dataset of `load_data.DATASETS` (run for at most
+    `max_iter` steps, as in the experiments) or a synthetic one (run over all of its reports). None if it is not available.
+    """
+    if name in SYNTHETIC:
+        n_features, n_values, n_reports = SYNTHETIC[name]
+        return lattice(n_features, n_values).get_data(n_reports) + (n_reports,)
+    if name not in DATASETS or not os.path.exists(DATASETS[name]['reports']):
+        return None
+    return get_data(name) + (max_iter,)
+
+def run_case(reports, group_dicts, base_rates, params, max_iter, beta=1.5, alpha=0.05, repeats=3):
+    """
+    Times `run_test` with `params` on the reports; returns a dict of measurements.
+    """
+    steps = min(max_iter, len(reports)) - 1
+    kwargs = dict(ALPHA=alpha, BETA=beta, max_iter=max_iter, **params)
+    times, cpu = [], []
+    with np.errstate(divide='ignore', invalid='ignore'): # warnings some tests raise on some datasets
+        for _ in range(repeats):
+            start, start_cpu = time.perf_counter(), time.process_time()
+            results = run_test(reports, group_dicts, base_rates, **kwargs)
+            times.append(time.perf_counter() - start)
+            cpu.append(time.process_time() - start_cpu)
+
+        tracemalloc.start()
+        run_test(reports, group_dicts, base_rates, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    best = min(times)
+    return {'G': len(group_dicts), 'N': len(reports), 'steps': steps, 'repeats': repeats,
+            'time_s': best, 'time_median_s': float(np.median(times)), 'cpu_s': min(cpu),
+            'reports_per_s': steps / best, 'step_latency_us': 1e6 * best / steps,
+            'peak_mb': peak / 2**20, 'n_rejected': len(results)}
+
+def run_benchmarks(workloads, cases, repeats=3, max_iter=40000, beta=1.5, alpha=0.05):
+    """
+    Runs every case of `cases` (names in `CASES`) on every workload; returns the JSON document.
+    """
+    results = []
+    for name in workloads:
+        workload = get_workload(name, max_iter)
+        if workload is None:
+            print(f'{name}: not available, skipped')
+            continue
+        reports, group_dicts, base_rates, workload_iter = workload
+        for case in cases:
+            record = {'workload': name, 'case': case, **run_case(reports, group_dicts, base_rates, CASES[case], workload_iter,
+                                                                  beta=beta, alpha=alpha, repeats=repeats)}
+            print(f"{name:>20} {case:>12}: {record['time_s']:8.3f}s  {record['reports_per_s']:10.0f} reports/s  "
+                  f"{record['step_latency_us']:8.1f} us/step  {record['peak_mb']:8.1f} MB")
+            results.append(record)
+    return {'meta': _environment(), 'config': {'repeats': repeats, 'max_iter': max_iter, 'beta': beta, 'alpha': alpha},
+            'results': results}
+
+def _environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except OSError:
+        revision = ''
+    return {'revision': revision or None, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+def compare(old, new, tolerance=0.1):
+    """
+    Side-by-side table of two benchmark documents, on the (workload, case) pairs both have.
+    `slower` marks cases whose best time grew by more than `tolerance` (relative).
+    """
+    key = ['workload', 'case']
+    columns = ['time_s', 'reports_per_s', 'peak_mb']
+    df = pd.DataFrame(old['results'])[key + columns].merge(pd.DataFrame(new['results'])[key + columns], on=key, suffixes=('_old', '_new'))
+    df['speedup'] = df['time_s_old'] / df['time_s_new']
+    df['slower'] = df['time_s_new'] > (1 + tolerance) * df['time_s_old']
+    return df
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--WORKLOADS', type=str, default='all', help='comma-separated datasets / synthetic workloads (default: all available)')
+    parser.add_argument('--CASES', type=str, default='all', help=f"comma-separated cases among {','.join(CASES)}")
+    parser.add_argument('--REPEATS', type=int, default=3)
+    parser.add_argument('--MAX_ITER', type=int, default=40000, help='max steps on the datasets (synthetic workloads use all their reports)')
+    parser.add_argument('--BETA', type=float, default=1.5)
+    parser.add_argument('--ALPHA', type=float, default=0.05)
+    parser.add_argument('--OUT', type=str, default=None, help='JSON file to write the results to')
+    parser.add_argument('--COMPARE', type=str, default=None, help='two comma-separated JSON files to compare (nothing is run)')
+    parser.add_argument('--TOLERANCE', type=float, default=0.1, help='relative slowdown reported as a regression by --COMPARE')
+    args = parser.parse_args()
+
+    if args.COMPARE:
+        old, new = [json.load(open(filename)) for filename in args.COMPARE.split(',')]
+        print(f"old: {old['meta']['revision']} ({old['meta']['time']}), new: {new['meta']['revision']} ({new['meta']['time']})")
+        df = compare(old, new, args.TOLERANCE)
+        print(df.to_string(index=False, float_format='%.3f'))
+        sys.exit(int(df['slower'].any()))
+
+    # datasets registered under several names (hmda / hmda_all-denials) are run once
+    datasets = [name for i, name in enumerate(DATASETS) if DATASETS[name] not in list(DATASETS.values())[:i]]
+    workloads = datasets + list(SYNTHETIC) if args.WORKLOADS == 'all' else args.WORKLOADS.split(',')
+    cases = list(CASES) if args.CASES == 'all' else args.CASES.split(',')
+    doc = run_benchmarks(workloads, cases, repeats=args.REPEATS, max_iter=args.MAX_ITER, beta=args.BETA, alpha=args.ALPHA)
+    if args.OUT:
+        with open(args.OUT, 'w') as f:
+            json.dump(doc, f, indent=1)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+"""
+    On-disk cache of experiment results, one entry per (dataset, base rates, code version, beta, alpha, algorithm, trial).
+
+    Entries are addressed by a hash of their content identifiers: the reports and groups, the base rates,
+    the source of the code that computes the results, the trial seeding (`max_iter`, `seed`), beta, alpha,
+    the algorithm config and the trial number (and the reporting model, if trials draw their own reports). Changing any of them gives new keys, so stale results are never reused.
+    Entries are written as soon as the trials computing them finish, so an interrupted run resumes where it stopped.
+"""
+
+CODE_FILES = ['algorithms.py', 'encoding.py', 'utils.py', 'sketch.py', 'reporting.py', 'run_experiment.py'] # run_experiment: trial seeding
+
+def code_version():
+    digest = hashlib.sha1()
+    for name in CODE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def dataset_hash(reports, group_dicts):
+    digest = hashlib.sha1(pd.util.hash_pandas_object(reports, index=True).values.tobytes())
+    digest.update(repr(list(group_dicts)).encode())
+    return digest.hexdigest()[:16]
+
+class ResultCache:
+    """
+    Results cache in the directory `path`; counts key hits and misses in `hits` / `misses`.
+    """
+    def __init__(self, path='cache'):
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'results.sqlite'), timeout=60)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS done (key TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS rows (key TEXT, pos INTEGER, grp INTEGER, t INTEGER, tinv INTEGER);
+            CREATE INDEX IF NOT EXISTS rows_key ON rows (key);
+            CREATE TABLE IF NOT EXISTS usage (key TEXT PRIMARY KEY, wall REAL, cpu REAL, rss REAL, reports INTEGER);
+        """)
+        self.hits, self.misses = 0, 0
+
+    def context(self, reports, group_dicts, base_rates, max_iter=40000, seed=None, reporting=None):
+        """
+        Identifiers shared by all entries of one dataset / configuration.
+        reporting: description of the reporting model trials draw their reports with, if any (`ThinningModel.describe()`).
+        """
+        ctx = {'data': dataset_hash(reports, group_dicts), 'base_rates': hashlib.sha1(np.asarray(base_rates, dtype=float).tobytes()).hexdigest()[:16],
+               'code': code_version(), 'max_iter': max_iter, 'seed': seed}
+        if reporting is not None:
+            ctx['reporting'] = reporting
+        return ctx
+
+    def missing(self, ctx, trials, betas, alphas, algorithms):
+        """
+        What is left to compute: (trials, betas, alphas, algorithms) covering every missing entry, or None if all are cached.
+        """
+        grid = self._grid(ctx, trials, betas, alphas, algorithms)
+        self._want(grid)
+        found = np.zeros(len(grid), dtype=bool)
+        found[[i for i, in self.db.execute('SELECT want.i FROM want JOIN done USING (key)')]] = True
+        self.hits += found.sum()
+        self.misses += (~found).sum()
+        if found.all():
+            return None
+        todo = grid[~found]
+        return (np.asarray(trials)[np.unique(todo['trial'])], np.asarray(betas)[np.unique(todo['beta'])],
+                np.asarray(alphas)[np.unique(todo['alpha'])], [algorithms[i] for i in np.unique(todo['alg'])])
+
+    def store(self, ctx, results, trials, betas, alphas, algorithms, usage=None):
+        """
+        Stores `run_trials` results (with a `beta` column) of every trial, beta, alpha and algorithm they were computed for.
+        Entries already in the cache (recomputed because `missing` covers a cross product) are replaced, not duplicated.
+        usage: resources used by each of them (`run_trials(..., return_usage=True)`), kept with them.
+        """
+        grid = self._grid(ctx, trials, betas, alphas, algorithms)
+        keys = {(betas[x.beta], trials[x.trial], alphas[x.alpha], algorithms[x.alg]['name']): x.key for x in grid}
+        row_keys = [keys[x] for x in results[['beta', 'trial', 'alpha', 'alg']].itertuples(index=False, name=None)]
+        pos = results.groupby(['beta', 'trial', 'alpha', 'alg'], sort=False).cumcount()
+        with self.db:
+            entries = [(key,) for key in grid['key'].tolist()]
+            self.db.executemany('DELETE FROM rows WHERE key = ?', entries)
+            self.db.executemany('DELETE FROM usage WHERE key = ?', entries)
+            self.db.executemany('INSERT OR IGNORE INTO done VALUES (?)', entries)
+            self.db.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?)',
+                                zip(row_keys, pos.tolist(), results['group'].tolist(), results['t'].tolist(), results['t-inv'].tolist()))
+            if usage is not None:
+                usage_keys = [keys[x] for x in usage[['beta', 'trial', 'alpha', 'alg']].itertuples(index=False, name=None)]
+                self.db.executemany('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?)',
+                                    zip(usage_keys, usage['wall_s'].tolist(), usage['cpu_s'].tolist(), usage['peak_rss_mb'].tolist(), usage['reports'].tolist()))
+
+    def load(self, ctx, trials, betas, alphas, algorithms):
+        """
+        Cached results in the format of `run_trials` with array `beta`, i.e. ordered by beta, trial, alpha, algorithm.
+        """
+        grid = self._grid(ctx, trials, betas, alphas, algorithms)
+        self._want(grid)
+        rows = pd.DataFrame(self.db.execute('SELECT want.i, pos, grp, t, tinv FROM rows JOIN want USING (key)').fetchall(),
+                            columns=['i', 'pos', 'group', 't', 't-inv'])
+        rows = rows.sort_values(['i', 'pos'])
+        cell = grid[rows['i'].to_numpy()]
+        return pd.DataFrame({'beta': np.asarray(betas)[cell['beta']], 'trial': np.asarray(trials)[cell['trial']],
+                             'alpha': np.asarray(alphas)[cell['alpha']], 'alg': np.array([alg['name'] for alg in algorithms])[cell['alg']],
+                             'group': rows['group'].to_numpy(), 't': rows['t'].to_numpy(), 't-inv': rows['t-inv'].to_numpy()})
+
+    def load_usage(self, ctx, trials, betas, alphas, algorithms):
+        """
+        Resources used by the cached entries (as returned by `run_trials(..., return_usage=True)` with array `beta`),
+        in the same order as `load`; entries stored without them are left out.
+        """
+        grid = self._grid(ctx, trials, betas, alphas, algorithms)
+        self._want(grid)
+        rows = pd.DataFrame(self.db.execute('SELECT want.i, wall, cpu, rss, reports FROM usage JOIN want USING (key)').fetchall(),
+                            columns=['i', 'wall_s', 'cpu_s', 'peak_rss_mb', 'reports']).sort_values('i')
+        cell = grid[rows['i'].to_numpy()]
+        usage = pd.DataFrame({'beta': np.asarray(betas)[cell['beta']], 'trial': np.asarray(trials)[cell['trial']],
+                              'alpha': np.asarray(alphas)[cell['alpha']], 'alg': np.array([alg['name'] for alg in algorithms])[cell['alg']],
+                              'wall_s': rows['wall_s'].to_numpy(), 'cpu_s': rows['cpu_s'].to_numpy(), 'peak_rss_mb': rows['peak_rss_mb'].to_numpy(),
+                              'reports': rows['reports'].to_numpy()})
+        # as in `run_experiment.get_usage`: the rate of the (trial, algorithm), whose time is split over its rows
+        return usage.assign(reports_per_s=usage['reports'] / usage.groupby(['trial', 'alg'])['wall_s'].transform('sum'))
+
+    def _grid(self, ctx, trials, betas, alphas, algorithms):
+        # every (beta, trial, alpha, alg) entry, in result order, with its key
+        b, k, a, g = np.meshgrid(np.arange(len(betas)), np.arange(len(trials)), np.arange(len(alphas)), np.arange(len(algorithms)), indexing='ij')
+        grid = np.rec.fromarrays([b.ravel(), k.ravel(), a.ravel(), g.ravel()], names=['beta', 'trial', 'alpha', 'alg'])
+        keys = [self._key(ctx, trials[x.trial], betas[x.beta], alphas[x.alpha], algorithms[x.alg]) for x in grid]
+        return np.rec.fromarrays([grid.beta, grid.trial, grid.alpha, grid.alg, keys], names=['beta', 'trial', 'alpha', 'alg', 'key'])
+
+    def _want(self, grid):
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS want (key TEXT PRIMARY KEY, i INTEGER)')
+        self.db.execute('DELETE FROM want')
+        self.db.executemany('INSERT INTO want VALUES (?, ?)', zip(grid['key'].tolist(), range(len(grid))))
+
+    def _key(self, ctx, trial, beta, alpha, alg):
+        content = dict(ctx, trial=int(trial), beta=float(beta), alpha=float(alpha), alg=alg)
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
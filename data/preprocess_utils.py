@@ -1,6 +1,9 @@
 import pickle
 from itertools import product
 
+import numpy as np
+import pandas as pd
+
 
 def get_groups(dem_vals, dem_cols):
     """
@@ -24,6 +27,60 @@ def get_groups(dem_vals, dem_cols):
     prod = product(*(dem_vals))
     return list(map(lambda x: {k: v for k, v in zip(dem_cols, x) if v is not None}, prod))[:-1]
 
+def count_tensor(df, dem_vals, dem_cols, weights=None):
+    """
+    :param df: pandas dataframe, one row per individual (or per survey cell, see `weights`)
+    :param dem_vals: list of lists of values for each demographic feature, as for `get_groups` (None entries are ignored)
+    :param dem_cols: list of demographic feature names
+    :param weights: optional column of df with the count of each row (default: each row counts once)
+
+    :returns: array with one axis per feature, from a single pass over df: 
+        counts[i, j, ...] is the number of rows with the i-th value of the first feature, the j-th of the second, ...
+        Each axis has one extra last entry for "any value" (incl. values not in dem_vals), so that 
+        `counts.reshape(-1)[:-1]` are the counts of the groups of `get_groups(dem_vals, dem_cols)`, in that order.
+    """
+    vals = [[v for v in vs if v is not None] for vs in dem_vals]
+    # one extra code per feature for values not in dem_vals
+    shape = tuple(len(vs) + 1 for vs in vals)
+    codes = []
+    for col, vs in zip(dem_cols, vals):
+        c = pd.Categorical(df[col], categories=vs).codes.astype(np.int64)
+        c[c < 0] = len(vs)
+        codes.append(c)
+    w = None if weights is None else df[weights].to_numpy(dtype=float)
+    counts = add_margins(np.bincount(np.ravel_multi_index(codes, shape), weights=w, minlength=int(np.prod(shape))).reshape(shape))
+    for axis, vs in enumerate(vals):
+        counts = np.delete(counts, len(vs), axis=axis)
+    return counts
+
+def add_margins(counts):
+    """
+    :param counts: array with one axis per feature, e.g. counts[i, j, ...] of the i-th value of the first feature, the j-th of the second, ...
+        (or probabilities of those cells)
+
+    :returns: counts with one extra last entry per axis for "any value" (the sum over that axis)
+    """
+    for axis in range(counts.ndim):
+        counts = np.concatenate([counts, counts.sum(axis=axis, keepdims=True)], axis=axis)
+    return counts
+
+def group_rates(counts, dem_vals, dem_cols, groups=None, total=None):
+    """
+    :param counts: counts (or rates) from `count_tensor`
+    :param dem_vals, dem_cols: as passed to `count_tensor`
+    :param groups: list of group dictionaries (default: the groups of `get_groups(dem_vals, dem_cols)`, in that order)
+    :param total: denominator of the rates (default: the total count)
+
+    :returns: array of rates, rates[i] corresponding to groups[i]
+    """
+    total = counts[(-1,) * counts.ndim] if total is None else total
+    if groups is None:
+        return counts.reshape(-1)[:-1] / total
+    lookups = [{v: i for i, v in enumerate(v for v in vs if v is not None)} for vs in dem_vals]
+    idx = tuple(np.array([lookup[group[col]] if col in group else len(lookup) for group in groups], dtype=np.int64)
+                for col, lookup in zip(dem_cols, lookups))
+    return counts[idx] / total
+
 def save_preprocessed(database, groups_list, base_rates, save_path):
     """
     :param database: pandas dataframe with the reports
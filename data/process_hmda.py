@@ -5,10 +5,7 @@ import pandas as pd
 import pickle
 
 from process_hmda_markup import markup_categorize_data, markup_clean_data
-from preprocess_utils import get_groups, save_preprocessed
-
-sys.path.append('..')
-from utils import _get_group_idx
+from preprocess_utils import get_groups, save_preprocessed, count_tensor, group_rates
 
 MARKUP_CLEANED_FILENAME = ''
 
@@ -118,7 +115,9 @@ dem_vals = [hmda19_df5[col].unique().tolist() + [None] for col in dem_cols]
 
 all_groups_dict = get_groups(dem_vals, dem_cols)
 
-base_group_rate = np.array([len(_get_group_idx(group, hmda19_df5))/len(hmda19_df5) for group in all_groups_dict])
+# counts of every sex x race x age cell (plus margins) in one pass; base rates of all groups follow by lookup
+base_counts = count_tensor(hmda19_df5, dem_vals, dem_cols)
+base_group_rate = group_rates(base_counts, dem_vals, dem_cols, total=len(hmda19_df5))
 
 # only keep groups that are sufficiently big overall
 nonzero_rate = base_group_rate[base_group_rate > 0.001] 
@@ -136,9 +135,9 @@ database = hmda19_df5[hmda19_df5['loan_outcome'] == 'Denied']
 save_path = 'hmda/hmda__'
 save_preprocessed(database, nonzero_groups, nonzero_rate, save_path)
 
-group_ys = []
-for group in nonzero_groups:
-    for key in group.keys():
-        database = database[database[key] == group[key]] 
-    group_ys.append(len(database[(database['loan_outcome'] == 'Denied') & (database['dti'] == 'healthy')]) / len(database))
+# share of each group's denials with a healthy dti, each group over its own denials
+denial_counts = group_rates(count_tensor(database, dem_vals, dem_cols), dem_vals, dem_cols, total=1)
+healthy_counts = group_rates(count_tensor(database[database['dti'] == 'healthy'], dem_vals, dem_cols), dem_vals, dem_cols, total=1)
+with np.errstate(invalid='ignore', divide='ignore'):
+    group_ys = (healthy_counts / denial_counts)[base_group_rate > 0.001].tolist()
 pickle.dump(group_ys, open(save_path + 'group_ys.pkl', 'wb'))
\ No newline at end of file
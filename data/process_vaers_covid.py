@@ -1,6 +1,5 @@
 # Preprocess the VAERS database.
 
-import sys
 import os
 import pickle 
 
@@ -13,20 +12,7 @@ import seaborn as sns
 
 
 from datetime import datetime
-from preprocess_utils import get_groups, save_preprocessed
-
-sys.path.append('..')
-from utils import _get_group_idx
-
-def inc_get_group_count(group, db, survey=0):
-    cdb = db.copy(deep=True)
-    for key in group.keys(): 
-        cdb = cdb.loc[(cdb[key] == group[key])]  
-    return cdb.shape[0]
-
-def inc_get_cat_count(group, db, survey=0):
-    cdb = db.copy(deep=True)
-    return cdb.shape[0]
+from preprocess_utils import get_groups, save_preprocessed, count_tensor, group_rates
 
 ###################################################
 # Settings 
@@ -317,43 +303,18 @@ with open('vaccine_groups_10yr.pkl', 'rb') as f:
     # Load the pickled object
     all_groups_dict = pickle.load(f)
 
-cdb_as = df_bcovid_age_sex.copy(deep=True)
-cdb_a = df_bcovid_age.copy(deep=True)
-
-total_age_count = cdb_a["Count"].sum()
-total_age_sex_count = cdb_as["Count"].sum()
-res = dict()
-
-for item in all_groups_dict:
-    ikeys = item.keys()
-    if ("Age" in ikeys) and (len(ikeys)<=1):
-        #Age only
-        print(item)
-        cdb = cdb_a.loc[(cdb_a["Group Category"] == item["Age"])]
-        cat_age_count = cdb["Count"].sum()
-        res[str(item)] = cat_age_count/total_age_count
-
-    if ("Sex" in ikeys) and (len(ikeys)<=1):
-        #Sex only 
-        print(item)
-        cdb = cdb_as.loc[(cdb_as["Group Category"] == item["Sex"])]
-        cat_sex_count = cdb["Count"].sum()
-        res[str(item)] = cat_sex_count/total_age_sex_count
-
-    if ("Sex" in ikeys) and (len(ikeys)>1):
-        #Sex, Age
-        #base rate is age base rate x gender base rate 
-        cdb1 = cdb_a.loc[(cdb_a["Group Category"] == item["Age"])]
-        cdb2 = cdb_as.loc[(cdb_as["Group Category"] == item["Sex"])]
-        cat_sex_count = cdb1["Count"].sum()
-        sex_base = cat_sex_count/total_age_sex_count
-        cat_age_count = cdb2["Count"].sum()
-        age_base = cat_age_count/total_age_count
-        res[str(item)] = sex_base*age_base
+# the surveys only have age and sex margins: age rates (with a last "any age" entry = 1) from the age table, 
+# sex rates from the sex table; an age x sex base rate is the product of its margins
+dem_vals = [df_icovid[col].unique().tolist() for col in dem_cols]
+age_counts = count_tensor(df_bcovid_age.rename(columns={"Group Category": "Age"}), dem_vals[:1], ["Age"], weights="Count")
+sex_counts = count_tensor(df_bcovid_age_sex.rename(columns={"Group Category": "Sex"}), dem_vals[1:], ["Sex"], weights="Count")
+base_tensor = np.outer(age_counts/age_counts[-1], sex_counts/sex_counts[-1])
+base_groups = group_rates(base_tensor, dem_vals, dem_cols, groups=all_groups_dict, total=1)
+res = {str(item): rate for item, rate in zip(all_groups_dict, base_groups)}
 
 #save base rates 
 with open('vaccine_base_rates_10yr.pkl', 'wb') as handle:
-    pickle.dump(np.array(list(res.values())), handle, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(base_groups, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 ###################################################
 # Get ground truth flagged groups 
@@ -363,10 +324,10 @@ base_rates = list()
 report_features = pd.read_csv('myocard_exact_vaccine_reports_10yr_Y.csv') #('myocarditis_exact_vaccine_reports_10yr_Y.csv') 
 
 BETA = 1.1
+report_rates = group_rates(count_tensor(report_features, dem_vals, dem_cols), dem_vals, dem_cols, groups=all_groups_dict, total=len(report_features))
 flagged_groups = {}
-for group in all_groups_dict:
+for group, report_group_rate in zip(all_groups_dict, report_rates):
     base_group_rate = res[str(group)] 
-    report_group_rate = inc_get_group_count(group, report_features) / inc_get_cat_count(group, report_features) 
     base_rates.append(base_group_rate)
     if report_group_rate >= BETA*base_group_rate and base_group_rate > 0.01:
         flagged_groups[frozenset(group.items())] = (report_group_rate/base_group_rate)
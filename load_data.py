@@ -1,85 +1,224 @@
-
+import copy
+import functools
+import hashlib
+import json
 import pickle
 import os.path
+import shutil
+import sys
+import time
+import numpy as np
 import pandas as pd
 
-def get_data(dataname = 'covid'):
-
-    if dataname == 'covid':
-
-        return _get_covid()
-    
-    if dataname == 'hmda' or dataname == 'hmda_all-denials':
-        
-        return _get_hmda(reports='all')
-
-    if dataname == 'hmda_hdti-denials':
-        
-        return _get_hmda(reports='hdti')
-
-    if dataname == 'hmda_corr':
-        
-        return _get_hmda(reports='corr')
+from reporting import get_reporting_model
+
+"""
+    Registry of datasets. Each dataset is described by a manifest:
+        reports, groups, base_rates: processed files (csv of reports, pickled list / array of group dicts, pickled base rates)
+        script: preprocessing script that writes them
+        where: {column: value} keeps only the reports matching all of them
+        report_rates: {'column': c, 'rates': {value: rate}}: each report is kept with the rate of its value of column c
+            (one fixed subsample; `get_base_data` gives the reports before it, plus the matching `reporting.ThinningModel`)
+        columns: report columns to keep (default all)
+
+    `compile_dataset` turns a dataset into a bundle of `.npy` files under `data_processed/compiled/<name>/`:
+    object columns of the reports are dictionary-encoded (codes + categories), groups are a group-spec table and
+    base rates an array. `get_data` loads a fresh bundle with `mmap_mode='r'` instead of re-parsing the source files,
+    and keeps the last few datasets in memory (handing out copies: reports are small-int codes, so copies are cheap).
+"""
+
+COMPILED_DIR = 'data_processed/compiled'
+BUNDLE_VERSION = 1
+
+_HMDA = {'reports': 'data_processed/hmda/hmda__denials.csv', 'groups': 'data_processed/hmda/hmda__groups.pkl',
+         'base_rates': 'data_processed/hmda/hmda__base_rates.pkl', 'script': 'data_processed/process_hmda.py'}
+_HMDA_CORR = {'columns': ['race', 'sex', 'age', 'dti']}
+
+DATASETS = {
+    'covid': {'reports': 'data_processed/vaers/covid__reports.csv', 'groups': 'data_processed/vaers/covid__groups.pkl',
+              'base_rates': 'data_processed/vaers/covid__base_groups.pkl', 'script': 'data_processed/process_covid.py'},
+    'hmda': _HMDA,
+    'hmda_all-denials': _HMDA,
+    'hmda_hdti-denials': dict(_HMDA, where={'dti': 'healthy'}),
+    'hmda_corr': dict(_HMDA, **_HMDA_CORR, report_rates={'column': 'dti', 'rates': {'struggling': 0.1, 'unmanageable': 0.3, 'manageable': 0.5, 'healthy': 0.9}}),
+    'hmda_anticorr': dict(_HMDA, **_HMDA_CORR, report_rates={'column': 'dti', 'rates': {'struggling': 0.9, 'unmanageable': 0.7, 'manageable': 0.5, 'healthy': 0.1}}),
+}
+
+def register_dataset(name, **manifest):
+    DATASETS[name] = manifest
+    _cached_data.cache_clear()
+    _cached_base_data.cache_clear()
 
-    if dataname == 'hmda_anticorr':
-        
-        return _get_hmda(reports='anticorr')
-
-    return "Dataset name not found - try `covid` or `hmda`"
-
-def _get_covid():
-    if not os.path.exists('data_processed/vaers/covid__reports.csv'):
-        print("Data not found - please run the preprocessing scripts in data_processed/process_covid.py first.")
+def get_data(dataname = 'covid'):
+    """
+    Returns (reports, group_dicts, base_rates) of dataset `dataname`, from its compiled bundle if it is up to date.
+    The last few datasets are kept in memory; every call returns its own copy, so callers may modify it.
+    Text columns of the reports are categoricals, whether they come from the bundle or from the source files.
+    """
+    if dataname not in DATASETS:
+        return "Dataset name not found - try `covid` or `hmda`"
+    return _copy(_cached_data(dataname))
+
+def get_base_data(dataname = 'covid'):
+    """
+    Returns (reports, group_dicts, base_rates, reporting model). For datasets with `report_rates`, the reports are the ones
+    before thinning and the model draws which of them are reported (see `reporting.py`); for others the model is None.
+    Copies, as for `get_data`.
+    """
+    return _copy(_cached_base_data(dataname))
+
+@functools.lru_cache(maxsize=8)
+def _cached_data(dataname):
+    bundle = load_bundle(dataname)
+    if bundle is not None:
+        return bundle
+    return _load_source(DATASETS[dataname])
+
+@functools.lru_cache(maxsize=8)
+def _cached_base_data(dataname):
+    manifest = DATASETS[dataname]
+    if 'report_rates' not in manifest:
+        return _cached_data(dataname) + (None,)
+    base = {key: value for key, value in manifest.items() if key != 'report_rates'}
+    return _load_source(base) + (get_reporting_model(manifest['report_rates']),)
+
+def _copy(data):
+    # a copy of cached (reports, group_dicts, base_rates[, model]) that does not share anything mutable with it
+    if data is None:
+        return None
+    reports, group_dicts, base_rates = data[:3]
+    return (reports.copy(), [dict(group) for group in group_dicts], np.array(base_rates)) + tuple(copy.deepcopy(data[3:]))
+
+def _load_source(manifest):
+    if not os.path.exists(manifest['reports']):
+        print(f"Data not found - please run the preprocessing scripts in {manifest['script']} first.")
         return
-    
-    reports = pd.read_csv('data_processed/vaers/covid__reports.csv')
-    group_dicts = pickle.load(open('data_processed/vaers/covid__groups.pkl', 'rb'))
-    base_rates = pickle.load(open('data_processed/vaers/covid__base_groups.pkl', 'rb'))
 
-    return reports, group_dicts, base_rates
+    reports = pd.read_csv(manifest['reports'])
+    group_dicts = pickle.load(open(manifest['groups'], 'rb'))
+    base_rates = pickle.load(open(manifest['base_rates'], 'rb'))
 
-def _get_hmda(reports='all'):
-
-    if not os.path.exists('data_processed/hmda/hmda__denials.csv'):
-        print("Data not found - please run the preprocessing scripts in data_processed/process_hmda.py first.")
-        return 
-    
-    all_denials = pd.read_csv('data_processed/hmda/hmda__denials.csv')
-    group_dicts = pickle.load(open('data_processed/hmda/hmda__groups.pkl', 'rb'))
-    base_rates = pickle.load(open('data_processed/hmda/hmda__base_rates.pkl', 'rb'))
-
-    if reports == 'all':
-        reports = all_denials
-    elif reports == 'hdti':
-        reports = all_denials[all_denials['dti'] == 'healthy']
-    elif reports == 'corr':
-        dti_to_report_rates = {
-            'struggling': 0.1,
-            'unmanageable': 0.3,
-            'manageable': 0.5,
-            'healthy': 0.9
-        }
-
-        reports = _get_corr_reports(dti_to_report_rates, all_denials)
-    elif reports == 'anticorr':
-        dti_to_report_rates = {
-            'struggling': 0.9,
-            'unmanageable': 0.7,
-            'manageable': 0.5,
-            'healthy': 0.1
-        }
-
-        reports = _get_corr_reports(dti_to_report_rates, all_denials)
+    for column, value in manifest.get('where', {}).items():
+        reports = reports[reports[column] == value]
+    if 'report_rates' in manifest:
+        reports = _get_corr_reports(manifest['report_rates']['rates'], reports, manifest['report_rates']['column'], manifest.get('columns'))
+    elif 'columns' in manifest:
+        reports = reports[manifest['columns']]
 
+    # text columns as categoricals, as in the compiled bundles
+    reports = reports.astype({name: 'category' for name in reports.columns if reports[name].dtype == object})
     return reports, group_dicts, base_rates
 
-def _get_corr_reports(dti_report_rates, all_denials):
-    g = all_denials.groupby('dti')
+def _get_corr_reports(report_rates, all_reports, column='dti', columns=['race', 'sex', 'age', 'dti']):
+    g = all_reports.groupby(column)
+
+    reports = pd.DataFrame(columns=columns)
+
+    for value in report_rates:
+        sampled = g.get_group(value).sample(frac=report_rates[value], random_state=0)
+        reports = pd.concat([reports, sampled[columns]], ignore_index=True)
+
+    return reports.sample(frac=1, random_state=0)
+
+##############################################
+############## compiled bundles ##############
+##############################################
+
+def _bundle_key(manifest):
+    # what the bundle was built from: the manifest and the size / modification time of its source files
+    sources = {key: os.stat(manifest[key]) for key in ['reports', 'groups', 'base_rates']}
+    content = {'version': BUNDLE_VERSION, 'manifest': manifest,
+               'sources': {key: [stat.st_size, stat.st_mtime_ns] for key, stat in sources.items()}}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def compile_dataset(dataname):
+    """
+    Writes the compiled bundle of dataset `dataname`; returns its directory.
+    """
+    manifest = DATASETS[dataname]
+    reports, group_dicts, base_rates = _load_source(manifest)
+    out = os.path.join(COMPILED_DIR, dataname)
+    tmp = out + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    columns = []
+    for i, name in enumerate(reports.columns):
+        values = reports[name]
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            values = pd.Categorical(values)
+            np.save(os.path.join(tmp, f'col{i}.codes.npy'), values.codes)
+            _save_values(os.path.join(tmp, f'col{i}.categories.npy'), values.categories)
+            columns.append({'name': name, 'kind': 'category'})
+        else:
+            np.save(os.path.join(tmp, f'col{i}.npy'), values.to_numpy())
+            columns.append({'name': name, 'kind': 'values'})
+    np.save(os.path.join(tmp, 'index.npy'), reports.index.to_numpy())
+
+    # groups: spec[g, f] = code of the value of feature f in group g (-1 if unconstrained), order[g, f] = position of f in the dict
+    features = list(dict.fromkeys(k for group in group_dicts for k in group))
+    spec = np.full((len(group_dicts), len(features)), -1)
+    order = np.full((len(group_dicts), len(features)), -1)
+    for f, k in enumerate(features):
+        values = pd.Categorical([group.get(k) for group in group_dicts])
+        spec[:, f] = values.codes
+        _save_values(os.path.join(tmp, f'group{f}.values.npy'), values.categories)
+    for g, group in enumerate(group_dicts):
+        for position, k in enumerate(group):
+            order[g, features.index(k)] = position
+    np.save(os.path.join(tmp, 'group_spec.npy'), spec)
+    np.save(os.path.join(tmp, 'group_order.npy'), order)
+    np.save(os.path.join(tmp, 'base_rates.npy'), np.asarray(base_rates))
+
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump({'name': dataname, 'key': _bundle_key(manifest), 'n_reports': len(reports), 'columns': columns, 'group_features': features}, f, indent=1)
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    return out
+
+def load_bundle(dataname):
+    """
+    (reports, group_dicts, base_rates) from the compiled bundle of `dataname`, or None if there is none or it is out of date.
+    """
+    path = os.path.join(COMPILED_DIR, dataname)
+    manifest = DATASETS[dataname]
+    if not os.path.exists(os.path.join(path, 'manifest.json')) or not os.path.exists(manifest['reports']):
+        return None
+    with open(os.path.join(path, 'manifest.json')) as f:
+        bundle = json.load(f)
+    if bundle['key'] != _bundle_key(manifest):
+        return None
+
+    data = {}
+    for i, column in enumerate(bundle['columns']):
+        if column['kind'] == 'category':
+            codes = np.load(os.path.join(path, f'col{i}.codes.npy'), mmap_mode='r')
+            data[column['name']] = pd.Categorical.from_codes(codes, categories=_load_values(os.path.join(path, f'col{i}.categories.npy')))
+        else:
+            data[column['name']] = np.load(os.path.join(path, f'col{i}.npy'), mmap_mode='r')
+    reports = pd.DataFrame(data, index=np.load(os.path.join(path, 'index.npy')), copy=False)
+
+    spec = np.load(os.path.join(path, 'group_spec.npy'))
+    order = np.load(os.path.join(path, 'group_order.npy'))
+    values = [_load_values(os.path.join(path, f'group{f}.values.npy')) for f in range(len(bundle['group_features']))]
+    group_dicts = []
+    for g in range(len(spec)):
+        fs = sorted(np.flatnonzero(order[g] >= 0), key=lambda f: order[g, f])
+        group_dicts.append({bundle['group_features'][f]: values[f][spec[g, f]] for f in fs})
+    base_rates = np.load(os.path.join(path, 'base_rates.npy'), mmap_mode='r')
+    return reports, group_dicts, base_rates
 
-    reports = pd.DataFrame(columns=['race', 'sex', 'age', 'dti'])
+def _save_values(filename, values):
+    # strings / numbers as a plain array (loadable with mmap); anything else pickled
+    values = np.asarray(values.tolist())
+    np.save(filename, values, allow_pickle=values.dtype == object)
 
-    for dti in dti_report_rates:
-        dti_sampled = g.get_group(dti).sample(frac=dti_report_rates[dti], random_state=0)
-        reports = pd.concat([reports, dti_sampled[['race', 'sex', 'age', 'dti']]], ignore_index=True)
+def _load_values(filename):
+    return np.load(filename, allow_pickle=True).tolist()
 
-    return reports.sample(frac=1, random_state=0) 
+if __name__ == '__main__':
+    # python load_data.py [dataset ...]: compiles the given datasets (default: all whose source files exist)
+    names = sys.argv[1:] or [name for name, manifest in DATASETS.items() if os.path.exists(manifest['reports'])]
+    for name in names:
+        start = time.time()
+        print(name, '->', compile_dataset(name), f'({time.time() - start:.2f}s)')
@@ -0,0 +1,370 @@
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from algorithms import get_test, run_test
+from encoding import GroupIndex
+from state import open_state
+
+"""
+    Online monitoring: reports arrive one at a time (or in small batches) instead of as a fixed `incident_db`,
+    and the test reports which groups it rejects as soon as it rejects them.
+"""
+
+class OnlineMonitor:
+    """
+    Stateful wrapper around a test (`GenericTest`, `SPRTest` or `LILTest`) that is advanced report by report.
+    Each update costs O(# nulls x # levels x G), however many reports were seen before, and never re-scans the history.
+
+    Rejection times follow `run`: the report ingested at step t is recorded as rejecting at time t + 1.
+    Values that no group asks for (or new values never seen before) are encoded as "other".
+    BETA: null (or array of nulls) to monitor, as in `run_trials`.
+    lmbd: betting strategy of `GenericTest` ('ons' or 'agrapa').
+    state_path: if given, the state is kept in this memory-mapped file (see `state.py`), written in place after 
+        every update and checkpointed every `checkpoint_every` reports; an existing file is resumed from.
+    """
+    def __init__(self, test, BETA=1.5, lmbd='ons', index=None, state_path=None, checkpoint_every=100000):
+        self.test = test
+        self.BETA = BETA
+        self.index = GroupIndex(test.all_groups) if index is None else index
+        test.index = self.index
+        test._start_batch(1, np.atleast_1d(BETA), lmbd, vectorized=False)
+        self.state, self.restored = None, False
+        if state_path is not None:
+            self.state, self.restored = open_state(state_path, test, np.atleast_1d(BETA), lmbd)
+        self.checkpoint_every = checkpoint_every
+        self._checkpoint_t = test.t
+
+    @property
+    def t(self):
+        return self.test.t
+
+    def update(self, report):
+        """
+        Ingests one report (dict or pd.Series of feature values).
+        Returns the newly rejected groups, as records `{'group': g, 't': t, 't-inv': t_inv}` (plus `beta` / `alpha` if several).
+        """
+        cell = self.index.encode_report(report)
+        if self.index.sparse:
+            return self._advance(None, np.array([[cell]]))
+        return self._advance(self.index.row_flags(cell)[None, None, :])
+
+    def update_batch(self, reports):
+        """
+        Ingests several reports (df, or list of dicts) in order; returns the groups newly rejected by any of them.
+        Missing features are encoded as "other", as in `update`.
+        """
+        reports = reports if isinstance(reports, pd.DataFrame) else pd.DataFrame(list(reports))
+        if len(reports) == 0:
+            return []
+        cells = self._encode(reports)
+        if self.index.sparse:
+            return self._advance(None, cells[None])
+        return self._advance(self.index.flags(cells)[None])
+
+    def consume(self, reports, batch_size=1):
+        """
+        Consumes an iterable (e.g. a generator) of reports, yielding each rejection record as soon as it happens.
+        Reports are ingested `batch_size` at a time.
+        """
+        batch = []
+        for report in reports:
+            batch.append(report)
+            if len(batch) < batch_size:
+                continue
+            yield from (self.update(batch[0]) if batch_size == 1 else self.update_batch(batch))
+            batch = []
+        if batch:
+            yield from self.update_batch(batch)
+
+    def results(self):
+        """
+        All rejections so far, in the format returned by `run`.
+        """
+        return self.test._batch_results(self.BETA).drop(columns='trial')
+
+    def checkpoint(self):
+        if self.state is not None:
+            self.state.checkpoint()
+            self._checkpoint_t = self.test.t
+
+    def close(self):
+        """
+        Checkpoints and closes the state file, if any.
+        """
+        if self.state is not None:
+            self.checkpoint()
+            self.state.close()
+            self.state = None
+
+    def _encode(self, reports):
+        # cells of a df of reports; missing features are encoded as "other", as in `update`
+        return self.index.encode(reports.reindex(columns=self.index.features))
+
+    def _advance(self, flags, cells=None):
+        # flags (1, n, G) of the reports, or their cells (1, n) with a sparse index
+        since = self.test.t
+        self.test._consume(flags, None, np.arange(since, since + (flags if cells is None else cells).shape[1]), cells=cells)
+        if self.state is not None:
+            self.state.save(self.test)
+            if self.test.t - self._checkpoint_t >= self.checkpoint_every:
+                self.checkpoint()
+        if not np.any(self.test.reject_t > since):
+            return []
+        return self.test._batch_results(self.BETA, since=since).drop(columns='trial').to_dict('records')
+
+class WindowedMonitor(OnlineMonitor):
+    """
+    Online monitor that forgets old reports, so that a recent surge is not diluted by a long history. Exactly one of:
+    window: the tests only see the last `window` reports;
+    horizon: the tests only see the reports of the last `horizon` (a timedelta, e.g. `pd.Timedelta(days=7)`, for 
+        datetime report times, otherwise a number in the units of the times). Report times are taken from the 
+        `time_column` of the reports, or passed to `update` / `update_batch`, and must not decrease;
+    decay: report weights are multiplied by `decay` (< 1) at every report (half-life of log(1/2) / log(decay) reports).
+
+    Counting tests (SPRT, LIL) keep the group counts and the number of reports over the window (or their decayed
+    versions) and evaluate `_closed_form_stats` on them. The betting test (ONS only) keeps the log-wealth and the ONS
+    sum of squared gradients over the window (or discounted by `decay`). Windows are ring buffers of the reports' 
+    cell ids (counting tests) or of their increments of the betting state (betting test): each report is added 
+    once and subtracted once when it leaves the window, so an update costs O(# nulls x # levels x G) amortized, 
+    whatever the window size.
+
+    A windowed statistic also goes down, so a group can alarm several times: once alarmed, it re-arms when its 
+    statistic is `margin` (default log(G), in the units of the statistic) below its threshold and the window has
+    forgotten every report it alarmed on (all of them left the window, or 1 / (1 - decay) reports went by). `t-inv` is
+    the first time since the group last re-armed (or since the start) at which the uncorrected condition held; invalid
+    times whose report left the window are forgotten. Nothing is forgotten with an unbounded window or `decay=1`, and
+    the alarms are then exactly the rejections of `run` (see `check_windowed`). Thresholds are those of the 
+    full-stream tests, so the level holds for the reports of one window (or for the decayed statistic at a fixed 
+    time), not over the whole unbounded stream.
+    State files are not supported.
+    """
+    def __init__(self, test, BETA=1.5, lmbd='ons', index=None, window=None, horizon=None, decay=None, time_column=None, margin=None, state_path=None):
+        if state_path is not None:
+            raise ValueError('windowed monitors do not support state files')
+        if sum(x is not None for x in (window, horizon, decay)) != 1:
+            raise ValueError('exactly one of window, horizon and decay must be given')
+        if not test.closed_form and lmbd != 'ons':
+            raise ValueError(f'windowed betting tests only support ons, not {lmbd}')
+        if decay is not None and not 0 < decay <= 1:
+            raise ValueError(f'decay must be in (0, 1], got {decay}')
+        super().__init__(test, BETA=BETA, lmbd=lmbd, index=index)
+        self.window, self.decay, self.time_column = window, decay, time_column
+        self.horizon, self._datetimes = horizon, False
+        if horizon is not None and isinstance(horizon, (pd.Timedelta, timedelta, np.timedelta64)):
+            self.horizon, self._datetimes = pd.Timedelta(horizon).value, True
+        self._last_time = None
+
+        self.counting = test.closed_form
+        betas = np.atleast_1d(BETA).astype(float)
+        self.betas = betas
+        if self.counting:
+            self._BETA, self._alpha = betas[:, None, None], test.alphas[:, None]
+            self.counts, self.n = np.zeros(test.G), 0.0
+        fields = {}
+        if horizon is not None:
+            fields['time'] = ((), np.int64 if self._datetimes else float)
+        if decay is None:
+            fields.update({'cell': ((), np.int64)} if self.counting else 
+                          {'d_omega': (test.omega_g.shape, float), 'd_counter': (test.lambda_counter.shape, float)})
+        self.ring = _Ring(window or 1024, fields)
+        self._evicted = 0
+
+        shape = (len(betas), len(test.alphas), test.G)
+        self.margin = np.log(test.G) if margin is None else margin
+        self.active = np.zeros(shape, dtype=bool) # groups alarmed and not re-armed yet
+        self.alarm_t = np.zeros(shape, dtype=int) # time of their last alarm
+        self.first_inv = np.zeros(shape, dtype=int) # first invalid time since they last re-armed (0 = none)
+        self.alarms = []
+
+    def update(self, report, time=None):
+        """
+        Ingests one report (dict or pd.Series of feature values), at `time` (default: its `time_column`).
+        Returns the alarms it raised, as records `{'group': g, 't': t, 't-inv': t_inv}` (plus `beta` / `alpha` if several).
+        """
+        time = None if self.horizon is None else self._times([report], None if time is None else [time])[0]
+        return self._step(self.index.encode_report(report), time)
+
+    def update_batch(self, reports, times=None):
+        """
+        Ingests several reports (df, or list of dicts) in order, at `times` (default: their `time_column`); 
+        returns the alarms raised by any of them.
+        """
+        reports = reports if isinstance(reports, pd.DataFrame) else pd.DataFrame(list(reports))
+        if len(reports) == 0:
+            return []
+        cells = self._encode(reports)
+        times = [None] * len(cells) if self.horizon is None else self._times(reports, times)
+        return [record for cell, time in zip(cells, times) for record in self._step(cell, time)]
+
+    def results(self):
+        """
+        All alarms so far, in the format returned by `run` (a group can appear several times).
+        """
+        columns = [name for name, multi in [('beta', np.ndim(self.BETA) > 0), ('alpha', self.test.multi_alpha)] if multi]
+        return pd.DataFrame(self.alarms, columns=columns + ['group', 't', 't-inv'])
+
+    def _times(self, reports, times):
+        # report times as numbers (ns for datetimes), from `times` or else the reports' time column
+        if times is None:
+            if self.time_column is None:
+                raise ValueError('a horizon needs report times: pass them, or set time_column')
+            times = [report[self.time_column] for report in reports] if not isinstance(reports, pd.DataFrame) else reports[self.time_column]
+        if self._datetimes:
+            return pd.DatetimeIndex(pd.to_datetime(times)).asi8
+        return np.asarray(times, dtype=float)
+
+    def _step(self, cell, time):
+        test = self.test
+        if time is not None:
+            if self._last_time is not None and time < self._last_time:
+                raise ValueError('report times must not decrease')
+            self._last_time = time
+            while self.ring.size and self.ring.peek('time') <= time - self.horizon:
+                self._evict()
+        elif self.window is not None and self.ring.size == self.window:
+            self._evict()
+
+        flags = self.index.row_flags(cell)
+        if self.counting:
+            if self.decay is not None:
+                self.counts *= self.decay
+                self.n *= self.decay
+            self.counts += flags
+            self.n += 1
+            if self.decay is None:
+                self.ring.push(cell=cell, time=time)
+            omega, thresh = test._closed_form_stats(self.counts, np.array([self.n]), self._BETA, self._alpha)
+            test.t += 1
+        else:
+            if self.decay is not None:
+                test.omega_g *= self.decay
+                test.lambda_counter *= self.decay
+                test._update_state(flags[None, None, None, :], test._BETA, test._lmbd)
+            else:
+                omega_0, counter_0 = test.omega_g.copy(), test.lambda_counter.copy()
+                test._update_state(flags[None, None, None, :], test._BETA, test._lmbd)
+                self.ring.push(time=time, d_omega=test.omega_g - omega_0, d_counter=test.lambda_counter - counter_0)
+            omega, thresh = test.omega_g[0], test.thresh
+        return self._check(omega, thresh)
+
+    def _evict(self):
+        # removes the oldest report of the window from the statistics
+        test = self.test
+        if self.counting:
+            self.counts -= self.index.row_flags(self.ring.peek('cell'))
+            self.n -= 1
+            self.ring.pop()
+            return
+        test.omega_g -= self.ring.peek('d_omega')
+        test.lambda_counter -= self.ring.peek('d_counter')
+        self.ring.pop()
+        # re-sum the window now and then, so that rounding errors of the subtractions do not build up
+        self._evicted += 1
+        if self._evicted >= max(self.ring.size, 64):
+            test.omega_g[...] = self.ring.sum('d_omega')
+            test.lambda_counter[...] = self.ring.sum('d_counter')
+            self._evicted = 0
+
+    def _check(self, omega, thresh):
+        # alarm records of the groups crossing their threshold at this step; re-arms the alarmed groups (see the class)
+        t, alpha = self.test.t, self.test.alphas[:, None]
+        omega, thresh = np.broadcast_arrays(omega, thresh)
+        gate = np.any(omega > thresh - np.log(self.test.G), axis=-1, keepdims=True)
+        invalid = gate & (omega > np.log(1/alpha))
+        rearm = self.active & (omega <= thresh - self.margin) & self._forgotten(self.alarm_t)
+        self.active &= ~rearm
+        self.first_inv[rearm | (~self.active & ~invalid & self._forgotten(self.first_inv))] = 0
+        self.first_inv[invalid & (self.first_inv == 0)] = t
+        raised = (omega > thresh) & ~self.active
+        self.active |= raised
+        self.alarm_t[raised] = t
+        records = []
+        for b, a, g in zip(*np.nonzero(raised)):
+            record = {}
+            if np.ndim(self.BETA) > 0:
+                record['beta'] = self.betas[b]
+            if self.test.multi_alpha:
+                record['alpha'] = self.test.alphas[a]
+            record.update({'group': int(g), 't': int(t), 't-inv': int(self.first_inv[b, a, g])})
+            records.append(record)
+        self.alarms.extend(records)
+        return records
+
+    def _forgotten(self, times):
+        # whether the reports up to (recorded) time `times` no longer weigh on the statistics
+        if self.decay is not None:
+            return self.decay < 1 and self.test.t - times >= 1 / (1 - self.decay)
+        return times <= self.test.t - self.ring.size
+
+class _Ring:
+    """
+    FIFO of fixed-shape records, oldest first, in preallocated arrays (one per field) that double when full.
+    """
+    def __init__(self, capacity, fields):
+        self.arrays = {name: np.zeros((capacity,) + shape, dtype=dtype) for name, (shape, dtype) in fields.items()}
+        self.capacity, self.head, self.size = capacity, 0, 0
+
+    def push(self, **values):
+        if self.size == self.capacity:
+            self._resize(2 * self.capacity)
+        i = (self.head + self.size) % self.capacity
+        for name, array in self.arrays.items():
+            array[i] = values[name]
+        self.size += 1
+
+    def peek(self, name):
+        return self.arrays[name][self.head]
+
+    def pop(self):
+        self.head = (self.head + 1) % self.capacity
+        self.size -= 1
+
+    def sum(self, name):
+        return self._ordered(self.arrays[name]).sum(axis=0)
+
+    def _ordered(self, array):
+        end = self.head + self.size
+        return array[self.head:end] if end <= self.capacity else np.concatenate([array[self.head:], array[:end - self.capacity]])
+
+    def _resize(self, capacity):
+        for name, array in self.arrays.items():
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.size] = self._ordered(array)
+            self.arrays[name] = grown
+        self.capacity, self.head = capacity, 0
+
+def get_monitor(all_groups, base_rates, ALPHA=0.05, BETA=1.5, method='eval', asymptotic=False, lmbd='ons', **kwargs):
+    """
+    Online counterpart of `run_test`. Other keyword arguments are passed to `OnlineMonitor`, or to `WindowedMonitor`
+    if any of `window`, `horizon` or `decay` is given.
+    """
+    test = get_test(all_groups, base_rates, ALPHA, method=method, asymptotic=asymptotic)
+    windowed = any(kwargs.get(name) is not None for name in ('window', 'horizon', 'decay'))
+    if not windowed:
+        kwargs = {name: value for name, value in kwargs.items() if name not in ('window', 'horizon', 'decay', 'time_column')}
+    return (WindowedMonitor if windowed else OnlineMonitor)(test, BETA=BETA, lmbd=lmbd, **kwargs)
+
+def check_windowed(incident_db, all_groups, base_rates, ALPHA=0.05, BETA=1.5, method='eval', asymptotic=False):
+    """
+    Checks that windowed monitors that forget nothing (a window as long as the stream, an infinite horizon, 
+    `decay=1`) alarm exactly when `run_test` rejects, on the reports of `incident_db` (in order).
+    Raises an AssertionError otherwise.
+    """
+    n = len(incident_db)
+    columns = [name for name, multi in [('beta', np.ndim(BETA) > 0), ('alpha', np.ndim(ALPHA) > 0)] if multi] + ['group', 't', 't-inv']
+    expected = run_test(incident_db, all_groups, base_rates, ALPHA=ALPHA, BETA=BETA, max_iter=n, method=method, asymptotic=asymptotic)
+    expected = expected[columns].sort_values(columns).reset_index(drop=True)
+    for kwargs in [{'window': n}, {'horizon': np.inf}, {'decay': 1.0}]:
+        monitor = get_monitor(all_groups, base_rates, ALPHA=ALPHA, BETA=BETA, method=method, asymptotic=asymptotic, **kwargs)
+        monitor.update_batch(incident_db, times=np.arange(n) if 'horizon' in kwargs else None)
+        results = monitor.results().astype(expected.dtypes.to_dict()).sort_values(columns).reset_index(drop=True)
+        pd.testing.assert_frame_equal(results, expected, obj=f'{method} monitor with {kwargs}')
+
+if __name__ == '__main__':
+    from synthetic import lattice
+
+    # the degenerate windows on a small synthetic lattice, for every method
+    reports, group_dicts, base_rates = lattice(3, 3, beta=4.0).get_data(5000)
+    for method, asymptotic in [('eval', False), ('sprt', False), ('lil', False), ('lil', True)]:
+        check_windowed(reports, group_dicts, base_rates, ALPHA=[0.01, 0.05], BETA=[1.5, 2.0], method=method, asymptotic=asymptotic)
+        print(f'{method}{" (asymptotic)" if asymptotic else ""}: ok')
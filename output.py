@@ -0,0 +1,194 @@
+import json
+import os
+import platform
+import queue
+import shutil
+import threading
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+"""
+    Writing (and reading back) experiment results.
+
+    Results are accumulated in preallocated typed columns (int32 trial / group / t / t-inv, categorical alg) and handed
+    in chunks to a background thread, which appends them to the legacy per-beta CSV files and writes them as Parquet
+    parts, partitioned by beta:
+        results/<dataset>_ntrials=<N>_beta=<beta>_alphas=<ALPHAS>.csv
+        results/<dataset>_ntrials=<N>_alphas=<ALPHAS>.parquet/beta=<beta>/part-<i>.parquet
+    Parquet needs pyarrow (or fastparquet); without it only the CSV files are written.
+    Next to each CSV file, a metadata sidecar records the run and the resources used by every (trial, alpha, algorithm):
+        results/<dataset>_ntrials=<N>_beta=<beta>_alphas=<ALPHAS>.meta.json
+"""
+
+COLUMNS = {'beta': np.float64, 'trial': np.int32, 'alpha': np.float64, 'alg': None, 'group': np.int32, 't': np.int32, 't-inv': np.int32}
+USAGE_COLUMNS = ['trial', 'alpha', 'alg', 'wall_s', 'cpu_s', 'peak_rss_mb', 'reports', 'reports_per_s']
+
+def csv_filename(dataset, n_trials, beta, alphas):
+    return 'results/' + str(dataset) + '_ntrials=' + str(n_trials) + '_' + 'beta=' + str(beta) + '_alphas=' + str(alphas) + '.csv'
+
+def parquet_dirname(dataset, n_trials, alphas):
+    return 'results/' + str(dataset) + '_ntrials=' + str(n_trials) + '_alphas=' + str(alphas) + '.parquet'
+
+def meta_filename(dataset, n_trials, beta, alphas):
+    return csv_filename(dataset, n_trials, beta, alphas)[:-len('.csv')] + '.meta.json'
+
+def parquet_available():
+    try:
+        pd.io.parquet.get_engine('auto')
+        return True
+    except ImportError:
+        return False
+
+class ResultColumns:
+    """
+    Growable typed columns; `alg` is stored as codes into `algs`.
+    """
+    def __init__(self, algs, capacity=1 << 16):
+        self.algs = pd.CategoricalDtype(list(algs))
+        self.n = 0
+        self.columns = {name: np.empty(capacity, dtype=np.int16 if dtype is None else dtype) for name, dtype in COLUMNS.items()}
+
+    def __len__(self):
+        return self.n
+
+    def append(self, results):
+        """
+        Appends results in the format of `run_trials` (with a `beta` column).
+        """
+        m = len(results)
+        if self.n + m > len(self.columns['t']):
+            capacity = max(2 * len(self.columns['t']), self.n + m)
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, capacity)
+        for name in COLUMNS:
+            values = results[name]
+            if name == 'alg':
+                values = pd.Categorical(values, dtype=self.algs).codes
+            self.columns[name][self.n:self.n + m] = values
+        self.n += m
+
+    def take(self):
+        """
+        Returns the rows appended so far as a typed df, and empties the columns (keeping their memory).
+        """
+        df = pd.DataFrame({name: column[:self.n].copy() for name, column in self.columns.items()})
+        df['alg'] = pd.Categorical.from_codes(df['alg'], dtype=self.algs)
+        self.n = 0
+        return df
+
+class ResultWriter:
+    """
+    Writes the results of one `run_experiment.py` run (dataset, # trials, betas, `--ALPHAS`) as they come in.
+    Results must be added in trial order; rows are flushed to the writer thread every `flush_rows` rows.
+    meta: description of the run (e.g. its arguments), written to the metadata sidecars with the resources used.
+        The sidecar totals add up the times of all rows, and the reports of every (trial, algorithm) once.
+    """
+    def __init__(self, dataset, n_trials, betas, alphas, algs, flush_rows=1 << 20, parquet=True, meta=None):
+        self.csv = {beta: csv_filename(dataset, n_trials, beta, alphas) for beta in betas}
+        self.meta = {beta: meta_filename(dataset, n_trials, beta, alphas) for beta in betas}
+        self.run = {'dataset': dataset, 'n_trials': n_trials, 'alphas': alphas, 'algorithms': list(algs), **(meta or {})}
+        self.usage = []
+        self.started = time.time()
+        self.parquet = parquet_dirname(dataset, n_trials, alphas) if parquet else None
+        if self.parquet and not parquet_available():
+            warnings.warn('pyarrow (or fastparquet) is not installed: writing CSV results only')
+            self.parquet = None
+        if self.parquet:
+            # the directory is shared by all betas: only replace the partitions of this writer's betas
+            for beta in betas:
+                part_dir = os.path.join(self.parquet, f'beta={beta}')
+                if os.path.exists(part_dir):
+                    shutil.rmtree(part_dir)
+        for filename in self.csv.values():
+            pd.DataFrame(columns=[name for name in COLUMNS if name != 'beta']).to_csv(filename, index=False)
+
+        self.columns = ResultColumns(algs)
+        self.flush_rows = flush_rows
+        self.n_parts = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=2) # at most two chunks waiting, so memory stays flat if writing is slow
+        self.thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self.thread.start()
+
+    def add(self, results, usage=None):
+        """
+        Adds results in the format of `run_trials` (with a `beta` column), and the resources used to get them if known
+        (`run_trials(..., return_usage=True)`, with a `beta` column).
+        """
+        if usage is not None:
+            self.usage.append(usage)
+        self.columns.append(results)
+        if len(self.columns) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if len(self.columns):
+            self.queue.put(self.columns.take())
+
+    def close(self):
+        """
+        Flushes what is left and waits for the writer thread.
+        """
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self._write_meta()
+
+    def _write_meta(self):
+        usage = pd.concat(self.usage, ignore_index=True) if self.usage else pd.DataFrame(columns=['beta'] + USAGE_COLUMNS)
+        for beta, filename in self.meta.items():
+            rows = usage[usage['beta'] == beta]
+            meta = dict(self.run, beta=beta, written=time.strftime('%Y-%m-%dT%H:%M:%S'), host=platform.node(), cpus=os.cpu_count(),
+                        elapsed_s=time.time() - self.started,
+                        totals={'wall_s': float(rows['wall_s'].sum()), 'cpu_s': float(rows['cpu_s'].sum()), 'reports': int(rows.drop_duplicates(['trial', 'alg'])['reports'].sum()),
+                                'peak_rss_mb': float(rows['peak_rss_mb'].max()) if len(rows) else None},
+                        usage={name: rows[name].tolist() for name in USAGE_COLUMNS})
+            with open(filename, 'w') as f:
+                json.dump(meta, f, indent=1, default=_json_default)
+
+    def _write_chunks(self):
+        while (chunk := self.queue.get()) is not None:
+            if self.error is not None:
+                continue
+            try:
+                self._write(chunk)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, chunk):
+        for beta, filename in self.csv.items():
+            rows = chunk[chunk['beta'] == beta].drop(columns='beta')
+            rows.to_csv(filename, mode='a', header=False, index=False)
+            if self.parquet and len(rows):
+                part_dir = os.path.join(self.parquet, f'beta={beta}')
+                os.makedirs(part_dir, exist_ok=True)
+                rows.to_parquet(os.path.join(part_dir, f'part-{self.n_parts:05d}.parquet'), index=False)
+        self.n_parts += 1
+
+def read_usage(dataset, n_trials, beta, alphas):
+    """
+    Resources used by every (trial, alpha, algorithm) of one beta, from its metadata sidecar (see `ResultWriter`),
+    and the rest of the sidecar (run description and totals).
+    """
+    with open(meta_filename(dataset, n_trials, beta, alphas)) as f:
+        meta = json.load(f)
+    return pd.DataFrame(meta.pop('usage')), meta
+
+def _json_default(value):
+    # numpy scalars in the run description
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+def read_results(dataset, n_trials, beta, alphas):
+    """
+    Results of one beta, as in its CSV file; read from the Parquet parts if they exist.
+    """
+    part_dir = os.path.join(parquet_dirname(dataset, n_trials, alphas), f'beta={beta}')
+    if os.path.isdir(part_dir) and parquet_available():
+        return pd.read_parquet(part_dir)
+    return pd.read_csv(csv_filename(dataset, n_trials, beta, alphas))
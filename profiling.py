@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+"""
+    Opt-in instrumentation of the tests: per-phase timers and counters, and callbacks fired on rejections.
+
+    A `Profiler` attached to a test (`profiler.attach(test)`, or `get_test(..., profiler=profiler)`) wraps the test's
+    phase methods on the instance only, so tests without a profiler run exactly the same code as before (no checks
+    on the hot path). Timing a call costs about a microsecond, i.e. a few percent of an `eval` step.
+"""
+
+# phase name of each instrumented method of `GenericTest`
+PHASES = {
+    '_get_row': 'row',                  # extraction of the current report (`iloc`, only with `encoded=False`)
+    '_get_row_flags': 'flags',          # membership flags of the current report
+    '_update_state': 'update',          # one step of the betting / counting state, incl. the phases below
+    '_update_omega': 'omega',
+    '_update_lambda': 'lambda',         # reported as lambda-ons / lambda-agrapa
+    '_check_rejections': 'bookkeeping', # rejection checks of `run` after each step
+    '_consume': 'consume',              # a block of steps of `run_trials` / the monitors
+    '_closed_form_stats': 'closed-form',
+}
+
+class Profiler:
+    """
+    Per-phase call counts and times of the tests it is attached to, plus counters of steps and rejections.
+    Times are inclusive ('total') and exclusive of nested phases ('self'): e.g. `update` includes `omega` and `lambda`.
+    trace: also keep every timed call, for `write_trace` (memory grows with the number of calls).
+    on_reject: callbacks `callback(test, record)` fired on each rejection, where record is as returned by
+        `OnlineMonitor.update`: `{'group', 't', 't-inv'}`, plus `trial`, `beta` and `alpha` indices for batch runs.
+    """
+    def __init__(self, trace=False, on_reject=()):
+        self.trace = trace
+        self.callbacks = list(on_reject)
+        self.reset()
+
+    def reset(self):
+        self.calls = defaultdict(int)
+        self.total = defaultdict(float)
+        self.self_time = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.events = [] # (phase, start, duration, thread id) of every timed call if `trace`
+        self.rejections = [] # (time, test name, record) for the trace
+        self._nested = threading.local()
+        self._start = time.perf_counter()
+
+    def on_reject(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def attach(self, test):
+        """
+        Instruments `test` (in place); returns it.
+        """
+        for method, phase in PHASES.items():
+            if hasattr(test, method):
+                setattr(test, method, self._timed(test, getattr(test, method), phase))
+        return test
+
+    def detach(self, test):
+        for method in PHASES:
+            test.__dict__.pop(method, None)
+        return test
+
+    def _timed(self, test, fn, phase):
+        after = {'bookkeeping': self._bookkeeping, 'consume': self._consume}.get(phase)
+        consume, lambda_phase = phase == 'consume', phase == 'lambda'
+
+        def timed(*args, **kwargs):
+            stack = self._stack()
+            stack.append(0.0)
+            before = test.reject_t == 0 if consume else None
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                child = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                name = f'lambda-{args[2]}' if lambda_phase else phase
+                self.calls[name] += 1
+                self.total[name] += elapsed
+                self.self_time[name] += elapsed - child
+                if self.trace:
+                    self.events.append((name, start, elapsed, threading.get_ident()))
+            if after is not None:
+                after(test, args, result, before)
+            return result
+        return timed
+
+    def _stack(self):
+        # times spent in nested phases, one entry per phase running in this thread
+        if not hasattr(self._nested, 'stack'):
+            self._nested.stack = []
+        return self._nested.stack
+
+    def _bookkeeping(self, test, args, new, before):
+        # `run`: one step; `new` is {group: invalid time} of the groups it rejected
+        self.counters['steps'] += 1
+        for group, t_inv in new.items():
+            self._reject(test, {'group': int(group), 't': int(test.t), 't-inv': int(t_inv)})
+
+    def _consume(self, test, args, result, before):
+        # batch runs: steps `ts` of every stream; rejections are the entries of `reject_t` set by this call
+        self.counters['steps'] += len(args[2])
+        for k, b, a, g in zip(*np.nonzero(before & (test.reject_t > 0))):
+            self._reject(test, {'trial': int(k), 'beta': int(b), 'alpha': int(a), 'group': int(g),
+                                't': int(test.reject_t[k, b, a, g]), 't-inv': int(test.invalid_t[k, b, a, g])})
+
+    def _reject(self, test, record):
+        self.counters['rejections'] += 1
+        if self.trace:
+            self.rejections.append((time.perf_counter(), type(test).__name__, record))
+        for callback in self.callbacks:
+            callback(test, record)
+
+    def summary(self):
+        """
+        df with one row per phase: number of calls, inclusive and exclusive time, mean time per call and share of
+        the total exclusive time, most expensive first.
+        """
+        df = pd.DataFrame({'phase': list(self.calls), 'calls': list(self.calls.values()),
+                           'total_s': [self.total[name] for name in self.calls],
+                           'self_s': [self.self_time[name] for name in self.calls]})
+        df['mean_us'] = 1e6 * df['total_s'] / df['calls']
+        df['share'] = df['self_s'] / df['self_s'].sum()
+        return df.sort_values('self_s', ascending=False, ignore_index=True)
+
+    def write_trace(self, filename):
+        """
+        Writes the timed calls (and rejections, as instant events) kept with `trace=True` in the Chrome trace event
+        format, to open in `chrome://tracing` or Perfetto.
+        """
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': 1e6 * (start - self._start), 'dur': 1e6 * elapsed, 'pid': pid, 'tid': tid}
+                  for name, start, elapsed, tid in self.events]
+        events += [{'name': 'reject', 'ph': 'i', 's': 'p', 'ts': 1e6 * (at - self._start), 'pid': pid, 'tid': 0,
+                    'args': dict(record, test=test)} for at, test, record in self.rejections]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': dict(self.counters)}, f)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+"""
+    Reporting models: which of the underlying events (e.g. all loan denials) end up being reported.
+
+    A model gives each event its probability of being reported. Rather than materializing one reported subset for
+    all trials (as `load_data` does for `hmda_corr` / `hmda_anticorr`), each trial can draw its own subset from its
+    own random stream (`get_trial_inds(..., keep_probs=...)` in `run_experiment.py`), so the results also vary
+    over which events get reported.
+"""
+
+class ThinningModel:
+    """
+    Independent (Bernoulli) thinning: an event is reported with probability `rates[value]`, where value is its value
+    of `column`; events whose value is not in `rates` are reported with probability `default` (by default never, as in
+    `load_data._get_corr_reports`).
+    """
+    def __init__(self, column, rates, default=0.0):
+        self.column = column
+        self.rates = dict(rates)
+        self.default = default
+
+    def probabilities(self, events):
+        """
+        Reporting probability of every row of the df `events`.
+        """
+        codes = pd.Categorical(events[self.column], categories=list(self.rates)).codes
+        # code -1 (value not in rates) picks the default
+        return np.append(np.fromiter(self.rates.values(), dtype=float), self.default)[codes]
+
+    def describe(self):
+        return {'model': 'thinning', 'column': self.column, 'rates': self.rates, 'default': self.default}
+
+def get_reporting_model(report_rates):
+    """
+    Model for the `report_rates` entry of a dataset manifest (see `load_data.DATASETS`), None if there is none.
+    """
+    if report_rates is None:
+        return None
+    return ThinningModel(report_rates['column'], report_rates['rates'], report_rates.get('default', 0.0))
+
+def thin(probabilities, rng):
+    """
+    Boolean mask of the reported events, each drawn independently with its probability in `probabilities`,
+    from `rng` (a numpy Generator or RandomState).
+    """
+    if isinstance(rng, np.random.RandomState):
+        return rng.random_sample(len(probabilities)) < probabilities
+    return rng.random(len(probabilities)) < probabilities
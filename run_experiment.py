@@ -4,9 +4,15 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import pickle 
 import argparse 
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from algorithms import *
-from load_data import get_data
+from load_data import get_data, get_base_data
+from reporting import thin
+from utils import reset_peak_rss, peak_rss
+from cache import ResultCache, code_version
+from output import ResultWriter
 
 """
 general set of all runs to do
@@ -19,56 +25,176 @@ all_algorithms = \
     { 'name': 'lila', 'params': {'method': 'lil', 'asymptotic': True}}
 ] 
 
-def run_one_trial(reports, group_dicts, base_rates, alphas=[0.1], beta=1.5, algorithms=None, trial=0, max_iter=40000):
+def run_one_trial(reports, group_dicts, base_rates, alphas=[0.1], beta=1.5, algorithms=None, trial=0, max_iter=40000, seed=None, keep_probs=None):
     """
-    ADD DOCSTRING
+    Runs every algorithm in `algorithms` (default `all_algorithms`) at every level in `alphas` on one random 
+    permutation of `reports`, seeded by `trial` (see `get_trial_inds`). 
+    All algorithms share a single pass over the reports (see `algorithms.run_fused`).
     """
-    np.random.seed(max_iter*trial)
-    trial_inds = np.random.permutation(reports.shape[0])
+    return run_trials(reports, group_dicts, base_rates, [trial], alphas=alphas, beta=beta, algorithms=algorithms, max_iter=max_iter, seed=seed, keep_probs=keep_probs)
+
+def get_trial_inds(n_reports, trials, max_iter=40000, seed=None, keep_probs=None):
+    """
+    Report permutations for `trials`. Each trial has its own random stream, so a trial's permutation 
+    does not depend on which other trials are run, in what order or in which process:
+    by default trial k is seeded with `max_iter*k` (as with `np.random.seed(max_iter*k)`); 
+    if `seed` is given, trial k uses a generator spawned from `np.random.SeedSequence(seed)` (its k-th child).
+    keep_probs: reporting probability of each report (see `reporting.py`). If given, each trial first draws 
+    which reports it keeps from its stream and then permutes those, so trials have different lengths (a list is returned).
+    """
+    trial_inds = []
+    for trial in trials:
+        if seed is None:
+            rng = np.random.RandomState(max_iter*trial)
+        else:
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(int(trial),)))
+        if keep_probs is None:
+            trial_inds.append(rng.permutation(n_reports))
+        else:
+            kept = np.flatnonzero(thin(keep_probs, rng))
+            trial_inds.append(kept[rng.permutation(len(kept))])
+    return np.array(trial_inds) if keep_probs is None else trial_inds
+
+def run_trials(reports, group_dicts, base_rates, trials, alphas=[0.1], beta=1.5, algorithms=None, max_iter=40000, seed=None, keep_probs=None,
+               return_usage=False):
+    """
+    `run_one_trial` for every trial in `trials` at once: all trial permutations, all `alphas` and all algorithms 
+    are run together in one fused pass (see `algorithms.run_algorithms`).
+    If `beta` is an array, every beta is tested in that same pass and results get a leading `beta` column.
+    Rows are ordered by (beta,) trial, alpha, algorithm.
+    keep_probs: if given, each trial runs on its own reported subset of `reports` (see `get_trial_inds`).
+    return_usage: also return the resources used by every (beta,) trial, alpha and algorithm (see `get_usage`).
+    """
+    start = np.array([time.perf_counter(), time.process_time()])
+    if return_usage:
+        reset_peak_rss()
+    multi_beta = np.ndim(beta) > 0
+    trials = np.asarray(trials)
+    alphas = np.asarray(alphas)
+    trial_inds = get_trial_inds(reports.shape[0], trials, max_iter=max_iter, seed=seed, keep_probs=keep_probs)
 
     algorithms = all_algorithms if algorithms is None else algorithms
 
-    result_df = pd.DataFrame(columns=['trial', 'alpha', 'alg'])
-    for alpha in alphas:
-        print("--alpha=", alpha)
-
-        for alg in algorithms:
-            alg['params']['ALPHA'] = alpha
-            alg['params']['BETA'] = beta
-            results = run_test(reports.iloc[trial_inds], group_dicts, base_rates, **alg['params'], max_iter=max_iter)
-            results['trial'] = trial
-            results['alpha'] = alpha
-            results['alg'] = alg['name']
-            result_df = pd.concat([result_df, results], ignore_index=True)
-    
-    return result_df
+    result_df = run_algorithms(reports, trial_inds, group_dicts, base_rates, algorithms, ALPHA=alphas, BETA=beta, max_iter=max_iter, return_usage=return_usage)
+    if return_usage:
+        result_df, usage = result_df
+    result_df['trial'] = trials[result_df['trial']]
+
+    # results come grouped by algorithm; reorder as (beta,) trial, alpha, algorithm
+    keys = [result_df['alpha'].map({alpha: i for i, alpha in enumerate(alphas)}), result_df['trial']]
+    if multi_beta:
+        keys.append(result_df['beta'].map({b: i for i, b in enumerate(beta)}))
+    result_df = result_df.iloc[np.lexsort(keys)].reset_index(drop=True)
+    result_df = result_df[(['beta'] if multi_beta else []) + ['trial', 'alpha', 'alg', 'group', 't', 't-inv']]
+    if not return_usage:
+        return result_df
+    total = np.array([time.perf_counter(), time.process_time()]) - start
+    return result_df, get_usage(usage, trials, alphas, beta, total, peak_rss())
+
+def get_usage(usage, trials, alphas, beta, total, peak):
+    """
+    Resources used by every (beta,) trial, alpha and algorithm of a batch, in the order of its results:
+    wall / CPU seconds, peak RSS (MB), reports processed and reports/sec.
+    The per-(trial, algorithm) times of `run_algorithms`' `usage` are split equally over the betas and levels (which
+    share every step) and scaled so that the rows add up to the `total` (wall, CPU) time of the batch, overhead included.
+    Reports are not split: every row has the reports of its (trial, algorithm), and reports/sec is that of the
+    (trial, algorithm), over all of its rows. Totals of reports are per (trial, algorithm), not sums of rows.
+    The peak RSS is the peak of the whole batch (it does not add up), in every row.
+    """
+    betas = np.atleast_1d(beta)
+    usage = usage.assign(trial=trials[usage['trial']])
+    for name, values in [('alpha', alphas), ('beta', betas)]:
+        usage = usage.loc[usage.index.repeat(len(values))].assign(**{name: np.tile(values, len(usage))}).reset_index(drop=True)
+    for column, spent in zip(['wall_s', 'cpu_s'], total):
+        usage[column] *= spent / usage[column].sum() if usage[column].sum() > 0 else 0
+    usage['peak_rss_mb'] = np.nan if peak is None else peak / 2**20
+    usage['reports_per_s'] = usage['reports'] / usage.groupby(['trial', 'alg'])['wall_s'].transform('sum')
+    keys = [usage['alpha'].map({alpha: i for i, alpha in enumerate(alphas)}), usage['trial']]
+    if np.ndim(beta) > 0:
+        keys.append(usage['beta'].map({b: i for i, b in enumerate(betas)}))
+    usage = usage.iloc[np.lexsort(keys)].reset_index(drop=True)
+    return usage[(['beta'] if np.ndim(beta) > 0 else []) + ['trial', 'alpha', 'alg', 'wall_s', 'cpu_s', 'peak_rss_mb', 'reports', 'reports_per_s']]
+
+def get_alphas(spec):
+    """
+    Levels for an `--ALPHAS` value: 'all', 'all_0.2' or a single level.
+    """
+    if spec == 'all':
+        return np.linspace(0.01, 0.1, 10)
+    elif spec == 'all_0.2':
+        return np.linspace(0.01, 0.2, 20)
+    else: 
+        return np.array([float(spec)])
+
+def _init_worker(reports, group_dicts, base_rates, keep_probs=None):
+    # each worker process keeps its own copy of the dataset, sent once
+    global _worker_data
+    _worker_data = (reports, group_dicts, base_rates, keep_probs)
+
+def _run_worker_trials(trials, kwargs):
+    reports, group_dicts, base_rates, keep_probs = _worker_data
+    return run_trials(reports, group_dicts, base_rates, trials, keep_probs=keep_probs, **kwargs)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--N_TRIALS', type=int, default=10)
     parser.add_argument('--BETA', type=float, default=1.5)
+    parser.add_argument('--BETAS', type=str, default=None, help='comma-separated betas tested in one pass, e.g. 1.5,2.0; overrides --BETA')
     parser.add_argument('--DATASET', type=str, default='folktables')
     parser.add_argument('--ALPHAS', type=str, default='0.1')
+    parser.add_argument('--TRIAL_BATCH', type=int, default=100, help='number of trials run together in one pass')
+    parser.add_argument('--WORKERS', type=int, default=1, help='number of processes to spread the trial batches over')
+    parser.add_argument('--SEED', type=int, default=None, help='root seed of the per-trial random streams (default: trial k seeded with max_iter*k)')
+    parser.add_argument('--CACHE', type=str, default='cache', help='directory of the result cache; trials already in it are not rerun (empty to disable)')
+    parser.add_argument('--PARQUET', type=int, default=1, help='also write results as Parquet (needs pyarrow)')
+    parser.add_argument('--RESAMPLE', type=int, default=0, help='for datasets with report rates (hmda_corr, hmda_anticorr): draw the reports per trial instead of using one fixed subsample; results go to <DATASET>_resampled files')
 
     args = parser.parse_args()
 
-    reports, group_dicts, base_rates = get_data(args.DATASET)
+    keep_probs, reporting, name = None, None, args.DATASET
+    if args.RESAMPLE:
+        reports, group_dicts, base_rates, model = get_base_data(args.DATASET)
+        if model is not None:
+            keep_probs, reporting, name = model.probabilities(reports), model.describe(), args.DATASET + '_resampled'
+    else:
+        reports, group_dicts, base_rates = get_data(args.DATASET)
 
     N_TRIALS = args.N_TRIALS
-    BETA = args.BETA
-    if args.ALPHAS == 'all':
-        ALPHAS = np.linspace(0.01, 0.1, 10)
-    elif args.ALPHAS == 'all_0.2':
-        ALPHAS = np.linspace(0.01, 0.2, 20)
-    else: 
-        ALPHAS = np.array([float(args.ALPHAS)])
+    BETAS = np.array([args.BETA] if args.BETAS is None else [float(beta) for beta in args.BETAS.split(',')])
+    ALPHAS = get_alphas(args.ALPHAS)
 
+    # only run what is not cached yet
+    trials, betas, alphas, algorithms = np.arange(N_TRIALS), BETAS, ALPHAS, all_algorithms
+    if args.CACHE:
+        cache = ResultCache(args.CACHE)
+        ctx = cache.context(reports, group_dicts, base_rates, seed=args.SEED, reporting=reporting)
+        trials, betas, alphas, algorithms = cache.missing(ctx, trials, BETAS, ALPHAS, all_algorithms) or ([], [], [], [])
+        print(f" ======== cache: {cache.hits} hits, {cache.misses} misses")
 
-    main_result_df = pd.DataFrame(columns=['trial', 'alpha', 'alg'])
-    for trial in np.arange(N_TRIALS):
-        print(" ======== trial = ", trial) 
-        main_result_df = pd.concat([main_result_df, run_one_trial(reports, group_dicts, base_rates, alphas = ALPHAS, beta = BETA, trial=trial)], ignore_index=True)
+    # with several workers, use smaller batches so that every worker gets some
+    batch_size = max(1, min(args.TRIAL_BATCH, -(-len(trials) // args.WORKERS)))
+    batches = [trials[start:start + batch_size] for start in range(0, len(trials), batch_size)]
+    kwargs = dict(alphas = alphas, beta = betas, algorithms = algorithms, seed = args.SEED, return_usage = True)
+    if args.WORKERS > 1:
+        pool = ProcessPoolExecutor(args.WORKERS, initializer=_init_worker, initargs=(reports, group_dicts, base_rates, keep_probs))
+        results = pool.map(_run_worker_trials, batches, [kwargs]*len(batches)) # in trial order, whatever order they finish in
+    else:
+        results = (run_trials(reports, group_dicts, base_rates, trials, keep_probs=keep_probs, **kwargs) for trials in batches)
 
-    filename = 'results/' + str(args.DATASET) + '_ntrials=' + str(N_TRIALS) + '_' + 'beta=' + str(BETA) + '_alphas=' + str(args.ALPHAS) + '.csv'
-    main_result_df.to_csv(filename, index=False)
\ No newline at end of file
+    # one results file per beta, as when running one beta per process
+    meta = {'workers': args.WORKERS, 'trial_batch': args.TRIAL_BATCH, 'seed': args.SEED, 'resample': args.RESAMPLE, 'code': code_version()}
+    writer = ResultWriter(name, N_TRIALS, BETAS, args.ALPHAS, [alg['name'] for alg in all_algorithms], parquet=args.PARQUET, meta=meta)
+    for batch, (result_df, usage) in zip(batches, results):
+        print(" ======== trials = ", batch[0], "-", batch[-1]) 
+        if args.CACHE:
+            cache.store(ctx, result_df, batch, betas, alphas, algorithms, usage=usage)
+        else:
+            writer.add(result_df, usage)
+    if args.WORKERS > 1:
+        pool.shutdown()
+    if args.CACHE:
+        for start in range(0, N_TRIALS, args.TRIAL_BATCH):
+            batch = np.arange(start, min(start + args.TRIAL_BATCH, N_TRIALS))
+            writer.add(cache.load(ctx, batch, BETAS, ALPHAS, all_algorithms), cache.load_usage(ctx, batch, BETAS, ALPHAS, all_algorithms))
+    writer.close()
\ No newline at end of file
@@ -1,11 +1,7 @@
 echo "hello"
 
-for beta in 1.8
-do
-    echo "Running experiments for beta=$beta"
-    for dataset in hmda_all-denials hmda_corr hmda_anticorr # hmda_hdti-denials 
-    do
-        echo "Running experiments for dataset=$dataset"
-        python run_experiment.py --DATASET=$dataset --BETA=$beta --N_TRIALS=100 
-    done
-done
+betas=1.8 # comma-separated, e.g. 1.5,1.8,2.0
+datasets=hmda_all-denials,hmda_corr,hmda_anticorr # hmda_hdti-denials
+
+echo "Running experiments for beta=$betas, datasets=$datasets"
+python sweep.py --DATASETS=$datasets --BETAS=$betas --N_TRIALS=100 --WORKERS=$(nproc)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+import numpy as np
+from load_data import get_data
+from monitor import get_monitor
+
+"""
+    asyncio service feeding reports from a local socket into an online monitor (see `monitor.py`).
+
+    Protocol: newline-delimited JSON over TCP. Each line is either a report (an object of feature values) or a command:
+    `{"subscribe": true}` to receive rejection events on this connection, `{"stats": true}` to get the current stats.
+    Incoming reports go through a bounded queue: when it is full, connections stop being read, so TCP flow control
+    pushes back on the clients. Queued reports are taken in micro-batches of up to `max_batch` and fed to
+    `monitor.update_batch` in a worker thread, so the event loop keeps accepting reports while the tests update.
+    Reports lacking some feature the groups use get an `{"error": ...}` reply instead of being queued, and a batch 
+    the monitor fails on is dropped (and counted in the stats) rather than stopping the service.
+"""
+
+class ReportService:
+    def __init__(self, monitor, max_queue=10000, max_batch=1024, latency_window=100000):
+        self.monitor = monitor
+        self.queue = asyncio.Queue(max_queue)
+        self.max_batch = max_batch
+        self.subscribers = set()
+        self.rejections = []
+        self.latencies = deque(maxlen=latency_window) # seconds from receipt to the end of the update, per report
+        self.n_reports, self.n_batches, self.n_dropped = 0, 0, 0
+        self.features = monitor.test.feature_names
+        self.first_received, self.last_done = None, None
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """
+        Starts accepting connections and processing reports; returns the asyncio server.
+        """
+        self._processor = asyncio.create_task(self.process())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        """
+        Stops accepting reports and closes all connections; reports still queued are dropped.
+        """
+        self.server.close()
+        self._processor.cancel()
+        for writer in list(self.subscribers):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    msg = None
+                if not isinstance(msg, dict):
+                    await _send(writer, {'error': 'expected a JSON object per line'})
+                elif msg.get('subscribe'):
+                    self.subscribers.add(writer)
+                elif msg.get('stats'):
+                    await _send(writer, self.stats())
+                elif missing := [k for k in self.features if k not in msg]:
+                    await _send(writer, {'error': f"report lacks features {', '.join(missing)}"})
+                else:
+                    received = time.perf_counter()
+                    if self.first_received is None:
+                        self.first_received = received
+                    await self.queue.put((received, msg)) # waits while the queue is full
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def process(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                events = await asyncio.to_thread(self.monitor.update_batch, [report for _, report in batch])
+            except Exception as e:
+                # a batch the monitor cannot take is dropped, so that the queue keeps moving
+                print(f'dropped a batch of {len(batch)} reports: {e!r}', file=sys.stderr)
+                self.n_dropped += len(batch)
+                events = []
+            else:
+                self.last_done = time.perf_counter()
+                self.latencies.extend(self.last_done - received for received, _ in batch)
+                self.n_reports += len(batch)
+                self.n_batches += 1
+            try:
+                for event in events:
+                    await self.publish(event)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def publish(self, event):
+        """
+        Sends a rejection event to every subscribed connection.
+        """
+        event = dict(event, event='rejection', features=self.monitor.test.all_groups[event['group']])
+        self.rejections.append(event)
+        for writer in list(self.subscribers):
+            try:
+                await _send(writer, event)
+            except ConnectionError:
+                self.subscribers.discard(writer)
+
+    def stats(self):
+        """
+        Sustained throughput (reports processed / time since the first report was received) and per-report latency.
+        """
+        stats = {'reports': self.n_reports, 'batches': self.n_batches, 'dropped': self.n_dropped, 'queued': self.queue.qsize(),
+                 'rejections': len(self.rejections), 'reports_per_sec': 0.}
+        if self.n_reports:
+            latencies = np.array(self.latencies) * 1000
+            stats['reports_per_sec'] = self.n_reports / max(self.last_done - self.first_received, 1e-9)
+            stats.update({f'latency_ms_{name}': q for name, q in zip(['p50', 'p90', 'p99'], np.percentile(latencies, [50, 90, 99]))})
+            stats['latency_ms_max'] = latencies.max()
+        return stats
+
+async def _send(writer, msg):
+    writer.write((json.dumps(msg, default=_to_builtin) + '\n').encode())
+    await writer.drain()
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+async def stand_in_client(reports, host='127.0.0.1', port=8765, rate=None, drain_every=256):
+    """
+    Local stand-in for report producers: sends `reports` (list of dicts) over one connection,
+    at `rate` reports/sec if given, else as fast as the service accepts them.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    start = time.perf_counter()
+    for i, report in enumerate(reports):
+        writer.write((json.dumps(report, default=_to_builtin) + '\n').encode())
+        if rate:
+            # pace against the schedule, not per report, so that sleep overshoots do not accumulate
+            await asyncio.sleep(max(0, start + (i+1)/rate - time.perf_counter()))
+        if i % drain_every == 0:
+            await writer.drain()
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+async def print_events(host='127.0.0.1', port=8765):
+    """
+    Subscribes to rejection events and prints them.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    await _send(writer, {'subscribe': True})
+    while line := await reader.readline():
+        print(line.decode().strip())
+
+async def main(args):
+    reports, group_dicts, base_rates = get_data(args.DATASET)
+    monitor = get_monitor(group_dicts, base_rates, ALPHA=args.ALPHA, BETA=args.BETA, method=args.METHOD,
+                          asymptotic=bool(args.ASYMPTOTIC), state_path=args.STATE, window=args.WINDOW, decay=args.DECAY)
+    service = ReportService(monitor, max_queue=args.MAX_QUEUE, max_batch=args.MAX_BATCH)
+    server = await service.serve(args.HOST, args.PORT)
+    print(f'listening on {args.HOST}:{args.PORT}')
+    if args.SERVE_ONLY:
+        async with server:
+            await server.serve_forever()
+
+    listener = asyncio.create_task(print_events(args.HOST, args.PORT))
+    n = len(reports) if args.N_REPORTS is None else args.N_REPORTS
+    reports = reports.sample(n, replace=n > len(reports), random_state=0).to_dict('records')
+    await stand_in_client(reports, args.HOST, args.PORT, rate=args.RATE)
+    await service.queue.join()
+    await asyncio.sleep(0.1) # let the last events reach the listener
+    await service.close()
+    await listener
+    print(json.dumps(service.stats(), indent=1))
+    monitor.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--DATASET', type=str, default='covid')
+    parser.add_argument('--METHOD', type=str, default='eval')
+    parser.add_argument('--ALPHA', type=float, default=0.05)
+    parser.add_argument('--ASYMPTOTIC', type=int, default=1, help='for --METHOD=lil: asymptotic LIL thresholds (1) or not (0)')
+    parser.add_argument('--BETA', type=float, default=1.5)
+    parser.add_argument('--HOST', type=str, default='127.0.0.1')
+    parser.add_argument('--PORT', type=int, default=8765)
+    parser.add_argument('--MAX_QUEUE', type=int, default=10000)
+    parser.add_argument('--MAX_BATCH', type=int, default=1024)
+    parser.add_argument('--STATE', type=str, default=None, help='memory-mapped state file to keep (and resume) the monitor state in')
+    parser.add_argument('--WINDOW', type=int, default=None, help='only monitor the last WINDOW reports (see monitor.WindowedMonitor)')
+    parser.add_argument('--DECAY', type=float, default=None, help='decay report weights by DECAY at every report (see monitor.WindowedMonitor)')
+    parser.add_argument('--SERVE_ONLY', action='store_true', help='only serve; otherwise a stand-in client sends the dataset reports')
+    parser.add_argument('--N_REPORTS', type=int, default=None, help='number of reports sent by the stand-in client')
+    parser.add_argument('--RATE', type=float, default=None, help='reports/sec sent by the stand-in client (default: as fast as possible)')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from algorithms import LILTest
+from encoding import GroupIndex, WILDCARD
+
+"""
+    Sketch-backed counting for the LIL test, for when there are too many candidate groups to keep exact counters
+    (and (trials x betas x levels x groups) state) for all of them.
+
+    All group counts go into a count-min sketch (conservative update) of fixed size. Estimates never undercount,
+    and the LIL thresholds only grow between two reports of a group, so a group can only cross its threshold at a
+    step where it is incremented and its estimate is already at least as high. A group is promoted to an exact
+    counter (computed from the reports so far) as soon as its estimate gets within `margin` of its threshold, and
+    rejections are only ever decided on exact counts: results are the same as `LILTest`'s. The sketch error only
+    decides how many groups get promoted, i.e. the cost.
+"""
+
+_PRIME = 2**31 - 1
+
+class CountMinSketch:
+    """
+    Count-min sketch of counts of integer keys (< 2^31), with conservative update.
+    Estimates are never below the true counts, and with width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)),
+    an estimate exceeds the true count by more than epsilon x (sum of all counts) with probability at most delta.
+    """
+    def __init__(self, epsilon=1e-4, delta=1e-3, seed=0, width=None, depth=None):
+        self.width = int(np.ceil(np.e / epsilon)) if width is None else width
+        self.depth = int(np.ceil(np.log(1 / delta))) if depth is None else depth
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        # pairwise independent hash per row: ((a * key + b) mod p) mod width
+        self._a = rng.integers(1, _PRIME, self.depth)[:, None]
+        self._b = rng.integers(0, _PRIME, self.depth)[:, None]
+        self._rows = np.arange(self.depth)[:, None]
+        self.total = 0
+
+    def _positions(self, keys):
+        return ((self._a * np.asarray(keys, dtype=np.int64) + self._b) % _PRIME) % self.width
+
+    def add(self, keys):
+        """
+        Adds one to the count of each of the (distinct) `keys`; returns upper bounds of their new counts.
+        Conservative update: each counter is only raised as far as the smallest counter of the key (+ 1) requires.
+        """
+        pos = self._positions(keys)
+        new = self.table[self._rows, pos].min(axis=0) + 1
+        np.maximum.at(self.table, (np.broadcast_to(self._rows, pos.shape), pos), np.broadcast_to(new, pos.shape))
+        self.total += len(pos[0])
+        return new
+
+    def estimate(self, keys):
+        return self.table[self._rows, self._positions(keys)].min(axis=0)
+
+    def error_bound(self):
+        """
+        Overcount of a single estimate that is exceeded with probability at most delta.
+        """
+        return np.e / self.width * self.total
+
+class SketchLILTest(LILTest):
+    """
+    `LILTest` with group counts kept in a `CountMinSketch` (see the top of this file); exact counters are only kept
+    for groups whose estimate gets within `margin` of their threshold (for some beta and level).
+    margin: default log(G), which also keeps the invalid (uncorrected) times exact: they depend on whether any group
+        is within log(G) of its threshold, and all such groups then have exact counters.
+    epsilon, delta, seed: sketch parameters (see `CountMinSketch`).
+    After a run, `promoted` lists the groups that got exact counters in the last trial.
+    """
+    fused = False
+
+    def __init__(self, all_groups, base_rates, ALPHA = 0.05, return_single=False, asymptotic=False, epsilon=1e-4, delta=1e-3, margin=None, seed=0):
+        super().__init__(all_groups, base_rates, ALPHA, return_single, asymptotic=asymptotic)
+        self.base_rates = np.asarray(base_rates, dtype=float)
+        self.epsilon, self.delta, self.seed = epsilon, delta, seed
+        self.margin = np.log(self.G) if margin is None else margin
+
+    def run(self, incident_db, max_iter=20000, lmbd=None, BETA=1, ALPHA=None, encoded=True, vectorized=True):
+        """
+        Same as `LILTest.run`.
+        """
+        return self.run_trials(incident_db, np.arange(len(incident_db))[None, :], max_iter=max_iter, BETA=BETA).drop(columns='trial')
+
+    def run_trials(self, incident_db, trial_inds, max_iter=20000, lmbd=None, BETA=1, vectorized=True):
+        """
+        Same as `LILTest.run_trials`; each trial is run in turn, for all betas and levels at once.
+        """
+        self.index = GroupIndex(self.all_groups)
+        cells = self.index.encode(incident_db)
+        betas = np.atleast_1d(BETA).astype(float)
+        records = []
+        for k, inds in enumerate(trial_inds):
+            for (b, a, g), (t, t_inv) in self._run_cells(cells[np.asarray(inds)], max_iter, betas).items():
+                records.append((k, betas[b], self.alphas[a], g, t, t_inv))
+        results = pd.DataFrame(records, columns=['trial', 'beta', 'alpha', 'group', 't', 't-inv'])
+        results = results.sort_values(['trial', 'beta', 'alpha', 't', 'group'], kind='stable').reset_index(drop=True)
+        return results.drop(columns=[name for name, multi in [('beta', np.ndim(BETA) > 0), ('alpha', self.multi_alpha)] if not multi])
+
+    def _run_cells(self, cells, max_iter, betas):
+        # one stream of encoded reports; returns {(beta index, level index, group): (t, t-inv)} of the rejections
+        n_steps = min(max_iter, len(cells)) - 1
+        self.sketch = CountMinSketch(self.epsilon, self.delta, self.seed)
+        uniq, self._inverse = np.unique(cells[:n_steps], return_inverse=True)
+        self._uniq_codes = self.index.codes(uniq)
+        self._contains = {}
+        slot = {} # group -> its position in promoted / counts
+        promoted, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        reject = {}
+        gate = np.zeros((len(betas), len(self.alphas), n_steps + 1), dtype=bool)
+
+        for n in range(1, n_steps + 1):
+            members = self.index.members(cells[n-1])
+            est = self.sketch.add(members)
+            counts[[slot[g] for g in members if g in slot]] += 1
+            candidates = members
+            if self.asymp and n == 25:
+                # the asymptotic threshold drops at t = 25: every group is a candidate once
+                candidates = np.arange(self.G)
+                est = self.sketch.estimate(candidates)
+            near = candidates[est >= self._thresh(n, candidates, betas).min(axis=(0, 1)) - self.margin]
+            new = [g for g in near if g not in slot]
+            if new:
+                for g in new:
+                    slot[g] = len(slot)
+                promoted = np.concatenate([promoted, new])
+                counts = np.concatenate([counts, [self._contains_group(g)[self._inverse[:n]].sum() for g in new]])
+            if not len(promoted):
+                continue
+
+            thresh = self._thresh(n, promoted, betas)
+            gate[:, :, n] = np.any(counts > thresh - np.log(self.G), axis=-1)
+            for b, a, i in zip(*np.nonzero(counts > thresh)):
+                reject.setdefault((b, a, promoted[i]), n + 1)
+
+        self.promoted = np.sort(promoted)
+        # invalid times: first step at which the gate is open and the group's count is above log(1/alpha)
+        results = {}
+        for (b, a, g), t in reject.items():
+            series = np.cumsum(self._contains_group(g)[self._inverse])
+            hits = np.flatnonzero(gate[b, a, 1:] & (series > np.log(1/self.alphas[a])))
+            results[(b, a, g)] = (t, hits[0] + 2 if len(hits) else 0)
+        return results
+
+    def _thresh(self, n, groups, betas):
+        # LIL thresholds (B, A, len(groups)) after n reports, as in `LILTest._closed_form_stats`
+        mu = betas[:, None, None] * self.base_rates[groups]
+        alpha = self.alphas[:, None]
+        thresh_factor = np.sqrt(np.minimum(mu, 1)*np.maximum((1-mu), 0)) if self.asymp else 0.5
+        thresh = n*mu + thresh_factor*np.sqrt(2.07*n*np.log((2+np.log2(n))**2/alpha))
+        if self.asymp and n < 25:
+            thresh = np.full(thresh.shape, 20000.)
+        return thresh
+
+    def _contains_group(self, g):
+        # whether each distinct cell of the stream is in group g
+        if g not in self._contains:
+            spec = self.index.spec[g]
+            self._contains[g] = np.all((spec == WILDCARD) | (spec == self._uniq_codes), axis=-1)
+        return self._contains[g]
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+
+"""
+    Persistent state of an online monitor (see `monitor.py`), kept in one contiguous memory-mapped file:
+    a small header (version, G, nulls, levels, base-rate hash, asymptotic flag, ...) followed by the test state arrays
+    and the rejection records. The monitor writes its state into the file in place after every update,
+    and every so often copies it to an atomically replaced checkpoint (`<path>.ckpt`).
+
+    Writes are bracketed by a sequence number (odd while a write is in progress), so a file left behind
+    mid-write by a crash is detected and the last checkpoint is used instead; other processes can use the
+    same number to take consistent snapshots while the monitor runs.
+"""
+
+MAGIC = b'RPTSTATE'
+VERSION = 2
+
+STATE_FIELDS = ['omega_g', 'lambda_g', 'lambda_counter', 'lambdavar_counter'] # (B, G), kept by the test as (1, B, 1, G)
+RECORD_FIELDS = ['reject_t', 'invalid_t'] # (B, A, G), kept by the test as (1, B, A, G)
+
+_HEADER = [('magic', 'S8'), ('version', '<i8'), ('G', '<i8'), ('B', '<i8'), ('A', '<i8'),
+           ('test', 'S16'), ('lmbd', 'S16'), ('asymptotic', '<i8'), ('base_rate_hash', 'S16'), ('seq', '<u8'), ('t', '<i8')]
+
+def state_dtype(G, B, A):
+    return np.dtype(_HEADER + [('betas', '<f8', (B,)), ('alphas', '<f8', (A,))]
+                    + [(name, '<f8', (B, G)) for name in STATE_FIELDS]
+                    + [(name, '<i8', (B, A, G)) for name in RECORD_FIELDS])
+
+def base_rate_hash(base_rates):
+    return hashlib.sha1(np.ascontiguousarray(base_rates, dtype='<f8').tobytes()).hexdigest()[:16].encode()
+
+def read_header(path):
+    header = np.fromfile(path, dtype=np.dtype(_HEADER), count=1)
+    if len(header) == 0 or header[0]['magic'] != MAGIC:
+        raise ValueError(f'{path} is not a monitor state file')
+    if header[0]['version'] != VERSION:
+        raise ValueError(f'{path} has state version {header[0]["version"]}, expected {VERSION}')
+    return header[0]
+
+class StateFile:
+    """
+    Memory-mapped state file. Fields are exposed without copying, e.g. `StateFile(path, mode='r')['omega_g']`.
+    """
+    def __init__(self, path, mode='r+'):
+        header = read_header(path)
+        self.path = path
+        self.G, self.B, self.A = int(header['G']), int(header['B']), int(header['A'])
+        self.mm = np.memmap(path, dtype=state_dtype(self.G, self.B, self.A), mode=mode, shape=(1,))
+
+    def __getitem__(self, name):
+        return self.mm[name][0]
+
+    @classmethod
+    def create(cls, path, test, betas, lmbd):
+        """
+        Writes a fresh state file for `test` (just set up by `_start_batch`) and opens it.
+        """
+        record = np.zeros(1, dtype=state_dtype(test.G, len(betas), len(test.alphas)))
+        record['magic'], record['version'] = MAGIC, VERSION
+        record['G'], record['B'], record['A'] = test.G, len(betas), len(test.alphas)
+        record['test'], record['lmbd'] = type(test).__name__, str(lmbd)
+        record['asymptotic'] = _asymptotic(test)
+        record['base_rate_hash'] = base_rate_hash(test.base_rates)
+        record['betas'], record['alphas'] = betas, test.alphas
+        _atomic_write(path, record.tobytes())
+        state = cls(path)
+        state.save(test)
+        return state
+
+    def check(self, test, betas, lmbd):
+        """
+        Raises ValueError if the file was written for a different test (or LIL thresholds), groups, base rates, nulls or levels.
+        """
+        expected = {'G': test.G, 'test': type(test).__name__.encode(), 'lmbd': str(lmbd).encode(), 'asymptotic': _asymptotic(test),
+                    'base_rate_hash': base_rate_hash(test.base_rates)}
+        bad = [name for name, value in expected.items() if self[name] != value]
+        if self.B != len(betas) or not np.array_equal(self['betas'], betas):
+            bad.append('betas')
+        if self.A != len(test.alphas) or not np.array_equal(self['alphas'], test.alphas):
+            bad.append('alphas')
+        if bad:
+            raise ValueError(f'{self.path} does not match the monitor ({", ".join(bad)} differ)')
+
+    def torn(self):
+        return self['seq'] % 2 == 1
+
+    def save(self, test):
+        """
+        Writes the state of `test` in place.
+        """
+        self.mm['seq'] += 1
+        for name in STATE_FIELDS:
+            self.mm[name][0] = getattr(test, name).reshape(self.B, self.G)
+        for name in RECORD_FIELDS:
+            self.mm[name][0] = getattr(test, name)[0]
+        self.mm['t'] = test.t
+        self.mm['seq'] += 1
+
+    def load(self, test):
+        """
+        Sets the state of `test` (already set up by `_start_batch`) from the file.
+        """
+        for name in STATE_FIELDS:
+            setattr(test, name, np.array(self[name]).reshape(1, self.B, 1, self.G))
+        for name in RECORD_FIELDS:
+            setattr(test, name, np.array(self[name])[None])
+        test.t = int(self['t'])
+
+    def snapshot(self):
+        """
+        Consistent copy of all fields, for readers in other processes.
+        """
+        while True:
+            seq = self['seq']
+            record = np.array(self.mm)
+            if seq % 2 == 0 and self['seq'] == seq:
+                return {name: record[name][0] for name in record.dtype.names}
+
+    def checkpoint(self):
+        """
+        Flushes the file and atomically replaces `<path>.ckpt` with a copy of it.
+        """
+        self.mm.flush()
+        _atomic_write(self.path + '.ckpt', self.mm.tobytes())
+
+    def close(self):
+        self.mm.flush()
+        del self.mm
+
+def open_state(path, test, betas, lmbd):
+    """
+    Opens the state file at `path` for `test` and loads it into the test, falling back to the last checkpoint
+    if the file is missing or was left mid-write; creates it if neither exists.
+    Returns (StateFile, whether state was restored).
+    """
+    ckpt = path + '.ckpt'
+    if (not os.path.exists(path) or read_header(path)['seq'] % 2 == 1) and os.path.exists(ckpt):
+        shutil.copyfile(ckpt, path)
+    if not os.path.exists(path):
+        return StateFile.create(path, test, betas, lmbd), False
+    state = StateFile(path)
+    if state.torn():
+        raise ValueError(f'{path} was left mid-write and there is no checkpoint to restore')
+    state.check(test, betas, lmbd)
+    state.load(test)
+    return state, True
+
+def _asymptotic(test):
+    # LIL tests with asymptotic thresholds (lila) and without (lilt) share a class
+    return int(getattr(test, 'asymp', False))
+
+def _atomic_write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
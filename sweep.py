@@ -0,0 +1,168 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from load_data import get_data, get_base_data
+from run_experiment import run_trials, get_alphas, all_algorithms
+from cache import ResultCache, code_version
+from output import ResultWriter
+
+"""
+    Runs a grid of experiments (DATASET x BETA x ALPHAS x N_TRIALS) in one process (plus workers),
+    writing the same results files as one `run_experiment.py` call per cell.
+
+    Cells of the same dataset share work: a trial's permutation only depends on its number and the tests at
+    different betas / levels do not interact, so every dataset is run once on trials 0 .. max(N_TRIALS)-1 at all of
+    its betas and levels together, and each cell's file is the corresponding slice. That work is split into units
+    of `TRIAL_BATCH` trials, run longest first on a pool of workers that share the datasets loaded once at startup.
+    With a result cache, only the (trials, betas, levels, algorithms) not in the cache yet are run.
+    With `--RESAMPLE`, datasets with report rates draw their reports per trial (see `reporting.py`).
+"""
+
+def expand_grid(datasets, betas, alpha_specs, n_trials):
+    """
+    One job per cell of the grid.
+    """
+    return [{'dataset': dataset, 'beta': beta, 'alphas': spec, 'n_trials': n}
+            for dataset in datasets for beta in betas for spec in alpha_specs for n in n_trials]
+
+def dataset_grid(jobs, dataset):
+    """
+    All trials, betas and levels needed by the jobs of `dataset`.
+    """
+    dataset_jobs = [job for job in jobs if job['dataset'] == dataset]
+    betas = np.unique([job['beta'] for job in dataset_jobs])
+    alphas = np.unique(np.concatenate([get_alphas(job['alphas']) for job in dataset_jobs]))
+    return np.arange(max(job['n_trials'] for job in dataset_jobs)), betas, alphas
+
+def plan_units(jobs, data, trial_batch=100, workers=1, todo=None):
+    """
+    Units of work `{'dataset', 'trials', 'betas', 'alphas', 'algorithms', 'cost'}` covering all jobs, sorted by estimated 
+    cost (largest first). The cost of a unit is taken as (# steps) x (# groups) x (# trials) x (# betas) x (# levels) x (# algorithms).
+    todo: {dataset: (trials, betas, alphas, algorithms) left to run, or None if nothing is}, by default everything.
+    """
+    todo = {dataset: dataset_grid(jobs, dataset) + (all_algorithms,) for dataset in data} if todo is None else todo
+    total_trials = sum(len(x[0]) for x in todo.values() if x is not None)
+    units = []
+    for dataset, x in todo.items():
+        if x is None:
+            continue
+        trials, betas, alphas, algorithms = x
+        reports, group_dicts = data[dataset][:2]
+        # smaller batches if needed to keep every worker busy
+        batch_size = trial_batch if workers == 1 else max(1, min(trial_batch, -(-total_trials // (4 * workers))))
+        for start in range(0, len(trials), batch_size):
+            unit_trials = trials[start:start + batch_size]
+            cost = min(len(reports), 40000) * len(group_dicts) * len(unit_trials) * len(betas) * len(alphas) * len(algorithms)
+            units.append({'dataset': dataset, 'trials': unit_trials, 'betas': betas, 'alphas': alphas, 'algorithms': algorithms, 'cost': cost})
+    return sorted(units, key=lambda unit: -unit['cost'])
+
+def write_results(jobs, chunks, parquet=True, name=None, meta=None):
+    """
+    Writes the files of `jobs` (all of one dataset) from `chunks`, (results, resources used) with a `beta` column
+    covering all trials in trial order (see `run_trials(..., return_usage=True)`).
+    name: dataset name in the file names (default the dataset's).
+    meta: description of the run, for the metadata sidecars (see `output.ResultWriter`).
+    """
+    betas = {}
+    for job in jobs:
+        betas.setdefault((job['alphas'], job['n_trials']), []).append(job['beta'])
+    writers = {(spec, n): ResultWriter(name or jobs[0]['dataset'], n, list(dict.fromkeys(b)), spec, [alg['name'] for alg in all_algorithms], parquet=parquet, meta=meta)
+               for (spec, n), b in betas.items()}
+    for chunk, usage in chunks:
+        for (spec, n), writer in writers.items():
+            alphas = get_alphas(spec)
+            df, cost = [x[x['beta'].isin(betas[spec, n]) & (x['trial'] < n) & x['alpha'].isin(alphas)] for x in (chunk, usage)]
+            order = lambda x: x.iloc[np.lexsort((x['alpha'].map({alpha: i for i, alpha in enumerate(alphas)}), x['trial']))]
+            writer.add(order(df), order(cost))
+    for writer in writers.values():
+        writer.close()
+
+def _cached_chunks(cache, ctx, trials, betas, alphas, trial_batch):
+    for start in range(0, len(trials), trial_batch):
+        batch = trials[start:start + trial_batch]
+        yield cache.load(ctx, batch, betas, alphas, all_algorithms), cache.load_usage(ctx, batch, betas, alphas, all_algorithms)
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _run_unit(unit, seed=None):
+    reports, group_dicts, base_rates, keep_probs = _worker_data[unit['dataset']]
+    return run_trials(reports, group_dicts, base_rates, unit['trials'], alphas=unit['alphas'], beta=unit['betas'], algorithms=unit['algorithms'],
+                      seed=seed, keep_probs=keep_probs, return_usage=True)
+
+def _load(dataset, resample=False):
+    # (reports, group_dicts, base_rates, keep_probs), reporting model description, name in the results files
+    if resample:
+        reports, group_dicts, base_rates, model = get_base_data(dataset)
+        if model is not None:
+            return (reports, group_dicts, base_rates, model.probabilities(reports)), model.describe(), dataset + '_resampled'
+    return get_data(dataset) + (None,), None, dataset
+
+def run_sweep(jobs, trial_batch=100, workers=1, seed=None, cache_dir='cache', parquet=True, resample=False):
+    loaded = {dataset: _load(dataset, resample) for dataset in dict.fromkeys(job['dataset'] for job in jobs)}
+    data = {dataset: x[0] for dataset, x in loaded.items()}
+    names = {dataset: x[2] for dataset, x in loaded.items()}
+    todo, cache = None, None
+    if cache_dir:
+        cache = ResultCache(cache_dir)
+        ctxs = {dataset: cache.context(*data[dataset][:3], seed=seed, reporting=loaded[dataset][1]) for dataset in data}
+        todo = {dataset: cache.missing(ctxs[dataset], *dataset_grid(jobs, dataset), all_algorithms) for dataset in data}
+        print(f'cache: {cache.hits} hits, {cache.misses} misses')
+    units = plan_units(jobs, data, trial_batch=trial_batch, workers=workers, todo=todo)
+    meta = {'workers': workers, 'trial_batch': trial_batch, 'seed': seed, 'resample': resample, 'code': code_version()}
+    print(f'{len(jobs)} jobs -> {len(units)} units over {len(data)} datasets, {workers} workers')
+
+    results = {dataset: [] for dataset in data}
+    remaining = {dataset: sum(unit['dataset'] == dataset for unit in units) for dataset in data}
+    for dataset in data:
+        if remaining[dataset] == 0:
+            chunks = _cached_chunks(cache, ctxs[dataset], *dataset_grid(jobs, dataset), trial_batch)
+            write_results([job for job in jobs if job['dataset'] == dataset], chunks, parquet=parquet, name=names[dataset], meta=meta)
+    start = time.time()
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(data,))
+        futures = {pool.submit(_run_unit, unit, seed): unit for unit in units}
+        done = ((futures[future], future.result()) for future in as_completed(futures))
+    else:
+        _init_worker(data)
+        done = ((unit, _run_unit(unit, seed)) for unit in units)
+
+    for unit, (result_df, usage) in done:
+        dataset = unit['dataset']
+        print(f" ======== {dataset}: trials = {unit['trials'][0]} - {unit['trials'][-1]} ({time.time() - start:.1f}s)")
+        if cache is not None:
+            cache.store(ctxs[dataset], result_df, unit['trials'], unit['betas'], unit['alphas'], unit['algorithms'], usage=usage)
+        else:
+            results[dataset].append((unit['trials'][0], result_df, usage))
+        remaining[dataset] -= 1
+        if remaining[dataset] == 0:
+            # all trials of the dataset are in: write its files, in trial order
+            if cache is not None:
+                chunks = _cached_chunks(cache, ctxs[dataset], *dataset_grid(jobs, dataset), trial_batch)
+            else:
+                chunks = [(df, usage) for _, df, usage in sorted(results.pop(dataset), key=lambda x: x[0])]
+            write_results([job for job in jobs if job['dataset'] == dataset], chunks, parquet=parquet, name=names[dataset], meta=meta)
+    if workers > 1:
+        pool.shutdown()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--DATASETS', type=str, default='covid', help='comma-separated datasets')
+    parser.add_argument('--BETAS', type=str, default='1.5', help='comma-separated betas')
+    parser.add_argument('--ALPHAS', type=str, default='0.1', help='comma-separated --ALPHAS values of run_experiment.py, e.g. 0.1,all')
+    parser.add_argument('--N_TRIALS', type=str, default='10', help='comma-separated numbers of trials')
+    parser.add_argument('--TRIAL_BATCH', type=int, default=100, help='max number of trials run together in one pass')
+    parser.add_argument('--WORKERS', type=int, default=1)
+    parser.add_argument('--SEED', type=int, default=None, help='as in run_experiment.py')
+    parser.add_argument('--CACHE', type=str, default='cache', help='as in run_experiment.py')
+    parser.add_argument('--PARQUET', type=int, default=1, help='as in run_experiment.py')
+    parser.add_argument('--RESAMPLE', type=int, default=0, help='as in run_experiment.py')
+    args = parser.parse_args()
+
+    jobs = expand_grid(args.DATASETS.split(','), [float(beta) for beta in args.BETAS.split(',')],
+                       args.ALPHAS.split(','), [int(n) for n in args.N_TRIALS.split(',')])
+    run_sweep(jobs, trial_batch=args.TRIAL_BATCH, workers=args.WORKERS, seed=args.SEED, cache_dir=args.CACHE, parquet=args.PARQUET, resample=args.RESAMPLE)
@@ -0,0 +1,132 @@
+import functools
+import numpy as np
+import pandas as pd
+
+from data.preprocess_utils import get_groups, add_margins, group_rates
+
+"""
+    Synthetic report streams, for testing the algorithms at sizes beyond the bundled datasets.
+
+    A stream is described by a feature schema (`dem_vals`, `dem_cols`, as for `preprocess_utils.get_groups`), the
+    distribution of the population over its cells (the base rates) and planted groups, each reported `beta` times
+    more often than its share of the population. Reports are drawn i.i.d. from the resulting report distribution
+    over cells, as (N, F) arrays of value codes (report[f] = index of its value in dem_vals[f]), in blocks of
+    `BLOCK` reports each drawn from its own random stream: report i only depends on the seed and i, so the same
+    reports come out whatever the chunking, and chunks can be generated in any order (or in parallel).
+
+    The matching `group_dicts` / `base_rates` (the groups of `get_groups`, in that order) and the ground truth
+    (groups whose expected report rate is above beta x their base rate) are exact, from the distributions.
+"""
+
+BLOCK = 1 << 16
+
+class SyntheticStream:
+    """
+    dem_vals, dem_cols: feature schema, as for `preprocess_utils.get_groups` (None entries are ignored).
+    population: distribution of the population over the cells: None (features independent and uniform), a list with
+        the distribution of each feature over its values (independent features), or the joint distribution as an
+        array with one axis per feature. Need not be normalized.
+    planted: list of (group dict, beta): reports from the group are `beta` times as likely as its population share.
+        Other cells keep their relative rates, so that each planted group's report rate is exactly beta x its base
+        rate if planted groups do not overlap (for overlapping ones, inflations multiply on the intersection).
+    seed: root seed; block b of reports is drawn from `np.random.SeedSequence(seed, spawn_key=(b,))`.
+    """
+    def __init__(self, dem_vals, dem_cols, population=None, planted=(), seed=0):
+        self.dem_cols = list(dem_cols)
+        self.dem_vals = [[v for v in vs if v is not None] for vs in dem_vals]
+        self.shape = tuple(len(vs) for vs in self.dem_vals)
+        self.group_dicts = get_groups([list(vs) for vs in self.dem_vals], self.dem_cols)
+        self.seed = seed
+        self.dtype = np.min_scalar_type(max(self.shape))
+
+        if population is None:
+            population = np.ones(self.shape)
+        elif not isinstance(population, np.ndarray) or population.ndim != len(self.shape):
+            population = functools.reduce(np.multiply, np.ix_(*[np.asarray(p, dtype=float) for p in population]))
+        population = np.asarray(population, dtype=float) / np.sum(population)
+        if population.shape != self.shape:
+            raise ValueError(f'population has shape {population.shape}, expected {self.shape}')
+
+        # reporting intensity of each cell: product of the betas of the planted groups containing it
+        inflation = np.ones(self.shape)
+        inside = np.zeros(self.shape, dtype=bool)
+        for group, beta in planted:
+            inflation[self._cells_of(group)] *= beta
+            inside[self._cells_of(group)] = True
+        mass = np.sum(population * inflation, where=inside)
+        if mass >= 1 or (mass > 0 and np.all(inside)):
+            raise ValueError('planted groups would take all the reports: lower their betas')
+        # cells outside the planted groups share what is left, in proportion to their population
+        outside = (1 - mass) / (1 - np.sum(population, where=inside)) if np.any(inside) else 1.0
+        reporting = population * np.where(inside, inflation, outside)
+
+        self.planted = [(dict(group), beta) for group, beta in planted]
+        self.base_rates = group_rates(add_margins(population), self.dem_vals, self.dem_cols)
+        self.report_rates = group_rates(add_margins(reporting), self.dem_vals, self.dem_cols)
+        self._cdf = np.cumsum(reporting.reshape(-1))
+        self._cdf /= self._cdf[-1]
+
+    def _cells_of(self, group):
+        # index of the cells of `group` into the (joint) cell array
+        return tuple(self.dem_vals[f].index(group[k]) if k in group else slice(None) for f, k in enumerate(self.dem_cols))
+
+    def ground_truth(self, BETA=1.5):
+        """
+        Indices of the groups whose expected report rate is above `BETA` x their base rate
+        (the groups `utils.get_flagged_groups` flags given enough reports).
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.flatnonzero(self.report_rates / self.base_rates > BETA)
+
+    def codes(self, start, stop):
+        """
+        (stop - start, F) array of the value codes of reports start .. stop-1.
+        """
+        first, last = start // BLOCK, -(-stop // BLOCK)
+        cells = np.concatenate([self._block(b) for b in range(first, last)]) if last > first else np.zeros(0, dtype=np.int64)
+        cells = cells[start - first * BLOCK:stop - first * BLOCK]
+        return np.stack(np.unravel_index(cells, self.shape), axis=1).astype(self.dtype)
+
+    def _block(self, b):
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(b,)))
+        return np.searchsorted(self._cdf, rng.random(BLOCK), side='right')
+
+    def stream(self, n_reports, chunk_size=1 << 20):
+        """
+        Generator of the value codes of the first `n_reports` reports, in chunks of `chunk_size` reports.
+        """
+        for start in range(0, n_reports, chunk_size):
+            yield self.codes(start, min(start + chunk_size, n_reports))
+
+    def to_memmap(self, filename, n_reports, chunk_size=1 << 20):
+        """
+        Writes the value codes of the first `n_reports` reports to the `.npy` file `filename`, chunk by chunk;
+        returns them memory-mapped (read-only).
+        """
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=self.dtype, shape=(n_reports, len(self.shape)))
+        for start in range(0, n_reports, chunk_size):
+            out[start:start + chunk_size] = self.codes(start, min(start + chunk_size, n_reports))
+        out.flush()
+        del out
+        return np.load(filename, mmap_mode='r')
+
+    def reports(self, codes):
+        """
+        df of reports with value codes `codes`, one categorical column per feature (as taken by the tests).
+        """
+        return pd.DataFrame({k: pd.Categorical.from_codes(codes[:, f], categories=self.dem_vals[f]) for f, k in enumerate(self.dem_cols)})
+
+    def get_data(self, n_reports):
+        """
+        (reports, group_dicts, base_rates) with the first `n_reports` reports, as `load_data.get_data` returns.
+        """
+        return self.reports(self.codes(0, n_reports)), self.group_dicts, self.base_rates
+
+def lattice(n_features, n_values, beta=2.0, seed=0):
+    """
+    Stream over `n_features` independent uniform features of `n_values` values each
+    ((n_values + 1)^n_features - 1 groups), with the first finest group planted at `beta`.
+    """
+    dem_cols = [f'f{i}' for i in range(n_features)]
+    dem_vals = [[f'v{j}' for j in range(n_values)] for _ in dem_cols]
+    return SyntheticStream(dem_vals, dem_cols, planted=[({k: vs[0] for k, vs in zip(dem_cols, dem_vals)}, beta)], seed=seed)
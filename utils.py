@@ -1,5 +1,9 @@
+import hashlib
+import sys
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
+from encoding import GroupIndex
 
 """
     actual_reports: df of all reports. each row is an individual report; 
@@ -20,17 +24,46 @@ def _get_group_idx(group, db):
         cdb = cdb.loc[(cdb[key] == group[key])]
     return cdb.index
 
+_group_counts = OrderedDict() # fingerprint -> counts, most recently used last
+
+def get_group_counts(reports, group_dicts, memo_size=16):
+    """
+    Number of reports in each group of `group_dicts`, for all groups at once: reports are encoded into cells and 
+    cell counts are mapped onto groups (see `encoding.GroupIndex.counts`). 
+    Results are memoized per fingerprint of (the group features of) `reports` and `group_dicts`.
+    """
+    key = _fingerprint(reports, group_dicts)
+    if key in _group_counts:
+        _group_counts.move_to_end(key)
+        return _group_counts[key]
+    index = GroupIndex(group_dicts)
+    counts = index.counts(index.encode(reports))
+    counts.flags.writeable = False
+    _group_counts[key] = counts
+    if len(_group_counts) > memo_size:
+        _group_counts.popitem(last=False)
+    return counts
+
+def _fingerprint(reports, group_dicts):
+    features = list(dict.fromkeys(k for group in group_dicts for k in group))
+    digest = hashlib.sha1(pd.util.hash_pandas_object(reports[features], index=False).values.tobytes())
+    digest.update(repr(list(group_dicts)).encode())
+    return digest.hexdigest()
+
 def get_flagged_groups(reports, group_dicts, base_rates, BETA=1.5):
     """
     Returns indices of groups that are flagged as having significantly higher reporting rates than the base rates (rather than as frozensets. )
     """
-    report_rates = np.array([len(_get_group_idx(group, reports)) for group in group_dicts])/len(reports)
+    report_rates = get_group_report_rates(reports, group_dicts)
     all_ratios = report_rates / base_rates
     flag_groups = np.where((all_ratios > BETA))[0]
     return flag_groups
 
+def get_group_report_rates(reports, group_dicts):
+    return get_group_counts(reports, group_dicts)/len(reports)
+
 def get_group_report_rate(reports, group):
-    return len(_get_group_idx(group, reports))/len(reports)
+    return get_group_report_rates(reports, [group])[0]
 
 def get_rows_where(group, data, keys):
     idx = _get_group_idx(group, data)
@@ -39,6 +72,34 @@ def get_rows_where(group, data, keys):
         group_df = group_df[group_df[key] == keys[key]]
     return group_df
 
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process (Linux only; elsewhere `peak_rss` is the peak since the process started).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes (since the last `reset_peak_rss` where supported), None if unknown.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
 def compute_logwealth(mug, beta, mug0, verbose=False):
     """
     Compute expected log-wealth. Expects scalar inputs.